@@ -0,0 +1,87 @@
+"""Small randomly initialised stand-in for the illust2vec caffemodels.
+
+The network has the layer names and output sizes of the real models (a
+``conv6_4`` layer with 1539 outputs for the tags and an ``encode1`` layer
+with 4096 outputs for the features), but only a few channels per hidden
+layer, so the benchmarks run offline and quickly on a CPU.
+"""
+import json
+
+import numpy as np
+from chainer.links.caffe.protobuf3 import caffe_pb2
+
+N_TAGS = 1539
+FEATURE_DIM = 4096
+LAYERS = [
+    ('conv1_1', 'conv'), ('pool1', 'pool'),
+    ('conv2_1', 'conv'), ('pool2', 'pool'),
+    ('conv3_1', 'conv'), ('conv3_2', 'conv'), ('pool3', 'pool'),
+    ('conv4_1', 'conv'), ('conv4_2', 'conv'), ('pool4', 'pool'),
+    ('conv5_1', 'conv'), ('conv5_2', 'conv'), ('pool5', 'pool'),
+    ('conv6_1', 'conv'), ('conv6_2', 'conv'), ('conv6_3', 'conv'),
+]
+
+
+def _add_blob(layer, shape, data):
+    blob = layer.blobs.add()
+    blob.shape.dim.extend(shape)
+    blob.data.extend(data.astype(np.float32).ravel())
+
+
+def _add_convolution(net, name, bottom, n_in, n_out, rng, relu=True):
+    layer = net.layer.add()
+    layer.name, layer.type = name, 'Convolution'
+    layer.bottom.append(bottom)
+    layer.top.append(name)
+    layer.convolution_param.num_output = n_out
+    layer.convolution_param.kernel_size.append(3)
+    layer.convolution_param.pad.append(1)
+    _add_blob(layer, [n_out, n_in, 3, 3],
+              rng.randn(n_out, n_in, 3, 3) * np.sqrt(2.0 / (9 * n_in)))
+    _add_blob(layer, [n_out], np.zeros(n_out))
+    if relu:
+        layer = net.layer.add()
+        layer.name, layer.type = 'relu' + name[4:], 'ReLU'
+        layer.bottom.append(name)
+        layer.top.append(name)
+
+
+def _add_pooling(net, name, bottom):
+    layer = net.layer.add()
+    layer.name, layer.type = name, 'Pooling'
+    layer.bottom.append(bottom)
+    layer.top.append(name)
+    layer.pooling_param.pool = layer.pooling_param.MAX
+    layer.pooling_param.kernel_size = 2
+    layer.pooling_param.stride = 2
+
+
+def make_caffemodel(path, channels=8, seed=0):
+    """Write a random caffemodel with the illust2vec layer names to ``path``."""
+    rng = np.random.RandomState(seed)
+    net = caffe_pb2.NetParameter()
+    bottom, n_in = 'data', 3
+    for name, kind in LAYERS:
+        if kind == 'conv':
+            _add_convolution(net, name, bottom, n_in, channels, rng)
+            n_in = channels
+        else:
+            _add_pooling(net, name, bottom)
+        bottom = name
+    _add_convolution(net, 'conv6_4', bottom, n_in, N_TAGS, rng, relu=False)
+    layer = net.layer.add()
+    layer.name, layer.type = 'encode1', 'InnerProduct'
+    layer.bottom.append(bottom)
+    layer.top.append('encode1')
+    layer.inner_product_param.num_output = FEATURE_DIM
+    _add_blob(layer, [FEATURE_DIM, n_in * 7 * 7],
+              rng.randn(FEATURE_DIM, n_in * 7 * 7) * np.sqrt(1.0 / (n_in * 49)))
+    _add_blob(layer, [FEATURE_DIM], np.zeros(FEATURE_DIM))
+    with open(path, 'wb') as f:
+        f.write(net.SerializeToString())
+
+
+def make_tag_list(path):
+    """Write a tag list of the size of the real one to ``path``."""
+    with open(path, 'w') as f:
+        json.dump(['tag {}'.format(i) for i in range(N_TAGS)], f)
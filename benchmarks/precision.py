@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+"""Compare the reduced precision modes of the tagging model with float32.
+
+Runs the images given as arguments (random images by default) through the
+model in float32 and in every reduced precision, and reports how far the
+probabilities move and how many of the top and plausible tags stay the
+same, as JSON::
+
+    python benchmarks/precision.py --model illust2vec_tag_ver200.caffemodel \\
+        --tags tag_list.json images/*.jpg
+
+Without ``--model`` the random network of :mod:`model` is used, which only
+checks the mechanics: its probabilities say nothing about the accuracy of
+the real model.
+"""
+from datetime import datetime
+import json
+import os.path as op
+import platform
+import sys
+import tempfile
+import time
+
+import click
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, op.dirname(op.dirname(op.abspath(__file__))))
+sys.path.insert(0, op.dirname(op.abspath(__file__)))
+
+from i2v import make_i2v_with_chainer  # noqa: E402
+from i2v.chainer_i2v import PRECISIONS  # noqa: E402
+import model  # noqa: E402
+
+
+def _weight_bytes(net):
+    """Return the number of bytes of the weights kept by ``net``."""
+    total = sum(param.array.nbytes for param in net.params() if param.array is not None)
+    for forward in net.forwards.values():
+        for data, scale in getattr(forward, 'weights', {}).values():
+            total += data.nbytes + (0 if scale is None else scale.nbytes)
+    return total
+
+
+def _agreement(expected, actual):
+    """Return the mean Jaccard similarity of two lists of tag sets."""
+    scores = [
+        len(a & b) / len(a | b) if a | b else 1.0
+        for a, b in zip(expected, actual)]
+    return float(np.mean(scores))
+
+
+def _tag_sets(tags):
+    return [
+        {tag for category in row.values() for tag, _ in category}
+        for row in tags]
+
+
+def compare(reference, candidate, images, n_tag):
+    """Return the differences of the predictions of ``candidate``."""
+    start = time.perf_counter()
+    prediction = candidate.predict(images)
+    seconds = time.perf_counter() - start
+    expected = reference.predict(images)
+    diff = np.abs(prediction.prob - expected.prob)
+    return {
+        'weight_bytes': _weight_bytes(candidate.net),
+        'seconds': seconds,
+        'max_abs_diff': float(diff.max()),
+        'mean_abs_diff': float(diff.mean()),
+        'top_tag_agreement': _agreement(
+            _tag_sets(expected.top_tags(n_tag)), _tag_sets(prediction.top_tags(n_tag))),
+        'plausible_tag_agreement': _agreement(
+            _tag_sets(expected.plausible_tags()), _tag_sets(prediction.plausible_tags())),
+    }
+
+
+@click.command()
+@click.argument('images', nargs=-1, type=click.Path(exists=True, dir_okay=False))
+@click.option('--model', 'param_path', type=click.Path(exists=True, dir_okay=False),
+              help='Caffemodel to compare instead of a random network.')
+@click.option('--tags', 'tag_path', type=click.Path(exists=True, dir_okay=False),
+              help='Tag list of the caffemodel.')
+@click.option('--output', '-o', type=click.Path(dir_okay=False),
+              help='Write the results to this file instead of stdout.')
+@click.option('--n-images', default=32, show_default=True,
+              help='Number of random images used when no image is given.')
+@click.option('--n-tag', default=10, show_default=True,
+              help='Number of top tags compared per category.')
+@click.option('--channels', default=8, show_default=True,
+              help='Number of channels of the hidden layers of the random network.')
+@click.option('--seed', default=0, show_default=True)
+def main(images, param_path, tag_path, output, n_images, n_tag, channels, seed):
+    rng = np.random.RandomState(seed)
+    if images:
+        images = [Image.open(path) for path in images]
+    else:
+        images = [
+            Image.fromarray(rng.randint(0, 256, (224, 224, 3), dtype=np.uint8))
+            for _ in range(n_images)]
+    with tempfile.TemporaryDirectory() as directory:
+        if param_path is None:
+            param_path = op.join(directory, 'random.caffemodel')
+            tag_path = op.join(directory, 'tag_list.json')
+            model.make_caffemodel(param_path, channels=channels, seed=seed)
+            model.make_tag_list(tag_path)
+        reference = make_i2v_with_chainer(param_path, tag_path, snapshot=False)
+        results = {'float32': {'weight_bytes': _weight_bytes(reference.net)}}
+        for precision in PRECISIONS[1:]:
+            candidate = make_i2v_with_chainer(
+                param_path, tag_path, snapshot=False, precision=precision)
+            results[precision] = compare(reference, candidate, images, n_tag)
+            click.echo('{:<8} max diff {:.2e}  top {:.3f}  plausible {:.3f}'.format(
+                precision, results[precision]['max_abs_diff'],
+                results[precision]['top_tag_agreement'],
+                results[precision]['plausible_tag_agreement']), err=True)
+
+    report = {
+        'meta': {
+            'created_at': datetime.now().isoformat(),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'model': op.basename(param_path),
+            'n_images': len(images),
+            'seed': seed,
+        },
+        'results': results,
+    }
+    if output is None:
+        click.echo(json.dumps(report, indent=2))
+    else:
+        with open(output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+"""Time the inference, postprocessing and persistence hot paths.
+
+Runs offline on a CPU against a small random network with the layer names of
+the real models (see :mod:`model`), and writes the timings as JSON::
+
+    python benchmarks/run.py --output results.json
+
+Every result records the benchmarked function, its parameters (batch size,
+image size, ...) and the minimum, median and mean wall time in seconds over
+``--repeat`` runs, so the outputs of two commits can be compared directly.
+"""
+from datetime import datetime
+import json
+import os
+import os.path as op
+import platform
+import statistics
+import sys
+import tempfile
+import time
+
+import chainer
+import click
+from flask import Flask
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, op.dirname(op.dirname(op.abspath(__file__))))
+sys.path.insert(0, op.dirname(op.abspath(__file__)))
+
+from i2v import checksum, make_i2v_with_chainer, models  # noqa: E402
+import model  # noqa: E402
+
+
+# the rating tags, as asked for by moderation
+RATING_TAGS = ['tag 1536', 'tag 1537', 'tag 1538']
+
+
+def measure(func, repeat, setup=None):
+    """Return timing statistics of ``repeat`` calls of ``func``.
+
+    ``setup`` is called untimed before every call and its result is passed
+    to ``func`` as positional arguments.
+    """
+    times = []
+    for _ in range(repeat):
+        args = setup() if setup is not None else ()
+        start = time.perf_counter()
+        func(*args)
+        times.append(time.perf_counter() - start)
+    return {
+        'min': min(times), 'median': statistics.median(times),
+        'mean': statistics.mean(times), 'repeat': repeat}
+
+
+def random_image(size, rng):
+    return Image.fromarray(rng.randint(0, 256, (size, size, 3), dtype=np.uint8))
+
+
+def random_prob(batch_size, rng):
+    # skewed towards zero like real predictions, so that only a few dozen
+    # tags per image pass the default threshold
+    return rng.beta(0.5, 10, (batch_size, model.N_TAGS)).astype(np.float32)
+
+
+def make_app():
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    models.db.init_app(app)
+    return app
+
+
+def bench_preprocessing(illust2vec, image_sizes, repeat, rng):
+    for size in image_sizes:
+        image = random_image(size, rng)
+        arr = illust2vec._convert_image(image)
+        yield {'name': '_convert_image', 'image_size': size}, \
+            measure(lambda: illust2vec._convert_image(image), repeat)
+        yield {'name': 'resize_image', 'image_size': size}, \
+            measure(lambda: illust2vec.resize_image(arr, illust2vec.input_size), repeat)
+        yield {'name': '_prepare_image', 'image_size': size}, \
+            measure(lambda: illust2vec._prepare_image(image), repeat)
+
+
+def bench_inference(illust2vec, batch_sizes, image_sizes, repeat, rng):
+    for batch_size in batch_sizes:
+        inputs = [illust2vec._prepare_image(random_image(224, rng))
+                  for _ in range(batch_size)]
+        yield {'name': '_forward', 'batch_size': batch_size}, \
+            measure(lambda: illust2vec._forward(inputs, 'conv6_4'), repeat)
+        for size in image_sizes:
+            images = [random_image(size, rng) for _ in range(batch_size)]
+            params = {'batch_size': batch_size, 'image_size': size}
+            yield dict(params, name='estimate_top_tags'), \
+                measure(lambda: illust2vec.estimate_top_tags(images), repeat)
+            yield dict(params, name='estimate_plausible_tags'), \
+                measure(lambda: illust2vec.estimate_plausible_tags(images), repeat)
+            yield dict(params, name='estimate_specific_tags'), \
+                measure(lambda: illust2vec.estimate_specific_tags(images, RATING_TAGS), repeat)
+            yield dict(params, name='extract_binary_feature'), \
+                measure(lambda: illust2vec.extract_binary_feature(images), repeat)
+            yield dict(params, name='extract'), \
+                measure(lambda: illust2vec.extract(images), repeat)
+
+
+def bench_postprocessing(illust2vec, batch_sizes, repeat, rng):
+    for batch_size in batch_sizes:
+        prob = random_prob(batch_size, rng)
+        yield {'name': '_top_tags', 'batch_size': batch_size}, \
+            measure(lambda: illust2vec._top_tags(prob), repeat)
+        yield {'name': '_plausible_tags', 'batch_size': batch_size}, \
+            measure(lambda: illust2vec._plausible_tags(prob), repeat)
+
+
+def bench_checksum(file_sizes, repeat, directory):
+    for size in file_sizes:
+        path = op.join(directory, 'checksum-{}.bin'.format(size))
+        with open(path, 'wb') as f:
+            f.write(os.urandom(size))
+        # clear the memoised digests so that every call reads the file
+        yield {'name': 'sha256_checksum', 'file_size': size}, \
+            measure(lambda: models.sha256_checksum(path), repeat,
+                    setup=lambda: checksum.CACHE.clear() or ())
+        paths = [path] * 8
+        yield {'name': 'file_sha256_many', 'file_size': size, 'n_files': len(paths)}, \
+            measure(lambda: checksum.file_sha256_many(paths, cache=None), repeat)
+
+
+def bench_persistence(illust2vec, repeat, rng):
+    app = make_app()
+    session = models.db.session
+    with app.app_context():
+        models.db.create_all()
+        counter = iter(range(sys.maxsize))
+        prob = random_prob(1, rng)
+        tags = {
+            'plausible': illust2vec._plausible_tags(prob)[0],
+            'top': illust2vec._top_tags(prob)[0],
+        }
+
+        def new_checksum():
+            checksum = models.Checksum(value='{:064x}'.format(next(counter)))
+            session.add(checksum)
+            session.commit()
+            return (checksum,)
+
+        for mode, estimation in tags.items():
+            params = {'mode': mode, 'n_tags': sum(map(len, estimation.values()))}
+
+            def update(checksum):
+                list(checksum.update_tag_estimation(estimation, mode=mode))
+                session.commit()
+
+            def bulk_update(checksum):
+                checksum.bulk_update_tag_estimation(estimation, mode=mode)
+                session.commit()
+
+            # the first call creates the tags, so warm up before timing
+            update(*new_checksum())
+            yield dict(params, name='update_tag_estimation'), \
+                measure(update, repeat, setup=new_checksum)
+            yield dict(params, name='bulk_update_tag_estimation'), \
+                measure(bulk_update, repeat, setup=new_checksum)
+        models.db.drop_all()
+
+
+def _int_list(ctx, param, value):
+    return [int(x) for x in value.split(',')]
+
+
+@click.command()
+@click.option('--output', '-o', type=click.Path(dir_okay=False),
+              help='Write the results to this file instead of stdout.')
+@click.option('--repeat', default=5, show_default=True)
+@click.option('--batch-sizes', default='1,8,32', show_default=True, callback=_int_list)
+@click.option('--image-sizes', default='224,512,1024', show_default=True, callback=_int_list)
+@click.option('--file-sizes', default='65536,1048576,8388608', show_default=True,
+              callback=_int_list)
+@click.option('--channels', default=8, show_default=True,
+              help='Number of channels of the hidden layers of the random network.')
+@click.option('--seed', default=0, show_default=True)
+def main(output, repeat, batch_sizes, image_sizes, file_sizes, channels, seed):
+    rng = np.random.RandomState(seed)
+    with tempfile.TemporaryDirectory() as directory:
+        param_path = op.join(directory, 'random.caffemodel')
+        tag_path = op.join(directory, 'tag_list.json')
+        model.make_caffemodel(param_path, channels=channels, seed=seed)
+        model.make_tag_list(tag_path)
+        illust2vec = make_i2v_with_chainer(param_path, tag_path, snapshot=False)
+
+        benchmarks = [
+            bench_preprocessing(illust2vec, image_sizes, repeat, rng),
+            bench_inference(illust2vec, batch_sizes, image_sizes, repeat, rng),
+            bench_postprocessing(illust2vec, batch_sizes, repeat, rng),
+            bench_checksum(file_sizes, repeat, directory),
+            bench_persistence(illust2vec, repeat, rng),
+        ]
+        results = []
+        for benchmark in benchmarks:
+            for params, timing in benchmark:
+                results.append(dict(params, seconds=timing))
+                click.echo('{:<28} {:<40} {:.6f}s'.format(
+                    params['name'],
+                    ' '.join('{}={}'.format(key, value)
+                             for key, value in sorted(params.items()) if key != 'name'),
+                    timing['median']), err=True)
+
+    report = {
+        'meta': {
+            'created_at': datetime.now().isoformat(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'numpy': np.__version__,
+            'chainer': chainer.__version__,
+            'channels': channels,
+            'seed': seed,
+        },
+        'results': results,
+    }
+    if output is None:
+        click.echo(json.dumps(report, indent=2))
+    else:
+        with open(output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,28 +1,35 @@
 #!/usr/bin/env python
 from pprint import pprint
+import itertools
+import json
 import os
 import os.path as op
 import sys
 
-from flask import Flask, __version__ as flask_version, send_from_directory
+from flask import Flask, Response, __version__ as flask_version, send_from_directory
 from flask_restful_swagger import swagger
 from flask.cli import FlaskGroup
 from flask_admin import Admin
+from flask_migrate import Migrate
 from flask_restful import Api
-from PIL import Image
 import click
+import structlog
 
-from . import make_i2v_with_chainer, views, models, resources
+from . import (
+    importer, make_i2v_with_chainer, metrics, views, models, pipeline, resources, store,
+    worker)
 
 
 __version__ = '0.2.1'
+logger = structlog.getLogger(__name__)
 
 
 class CustomFlaskGroup(FlaskGroup):
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
-        self.params[0].help = 'Show the program version'
-        self.params[0].callback = get_custom_version
+        version_option = next(param for param in self.params if param.name == 'version')
+        version_option.help = 'Show the program version'
+        version_option.callback = get_custom_version
 
 
 def get_custom_version(ctx, param, value):
@@ -37,11 +44,20 @@ def get_custom_version(ctx, param, value):
     ctx.exit()
 
 
-def create_app():
+def create_app(preload=None):
+    """Create the server application.
+
+    With ``preload`` (default: ``ILLUSTRATION2VEC_PRELOAD``), the tagging
+    model, and with ``'all'`` the feature model too, is loaded and warmed up
+    here, e.g. before ``gunicorn --preload`` forks its workers.
+    """
+    if preload is None:
+        preload = os.getenv('ILLUSTRATION2VEC_PRELOAD')
     app = Flask(__name__)
-    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = 'True'
-    app.config['DATABASE_FILE'] = 'i2v.sqlite'
-    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + app.config['DATABASE_FILE']
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    app.config['SQLALCHEMY_DATABASE_URI'] = models.database_url()
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = models.engine_options(
+        app.config['SQLALCHEMY_DATABASE_URI'])
     app.config['SECRET_KEY'] = os.getenv('ILLUSTRATION2VEC_SECRET_KEY') or os.urandom(24)
     # Create directory for file fields to use
     try:
@@ -51,6 +67,7 @@ def create_app():
         pass
     # app and db
     models.db.init_app(app)
+    Migrate(app, models.db, directory=op.join(op.dirname(__file__), 'migrations'))
     app.app_context().push()
     models.db.create_all()
     # other setup
@@ -60,6 +77,11 @@ def create_app():
     api.add_resource(resources.ChecksumTag, '/api/checksum/<int:c_id>/tag/<int:t_id>')
     api.add_resource(resources.ChecksumInvalidTag, '/api/checksum/<int:c_id>/invalid_tag/<int:t_id>')
     api.add_resource(resources.ChecksumTagList, '/api/checksum/<int:c_id>/tag')
+    api.add_resource(resources.ChecksumSimilar, '/api/checksum/<int:c_id>/similar')
+    api.add_resource(resources.ChecksumSimilarFeature, '/api/checksum/<int:c_id>/similar-feature')
+    api.add_resource(resources.ChecksumTagJob, '/api/checksum/<int:c_id>/job')
+    api.add_resource(resources.TagJob, '/api/job/<int:j_id>')
+    api.add_resource(resources.Estimate, '/api/estimate')
 
     # admin
     admin = Admin(
@@ -70,35 +92,156 @@ def create_app():
     admin.add_view(views.ChecksumView(models.Checksum, models.db.session))
     admin.add_view(views.TagEstimationView(models.TagEstimation, models.db.session))
     app.add_url_rule('/file/<filename>', 'file', view_func=lambda filename: send_from_directory(models.file_path, filename))
+    app.add_url_rule(
+        '/metrics', 'metrics',
+        view_func=lambda: Response(metrics.REGISTRY.expose(), mimetype='text/plain; version=0.0.4'))
     app.logger.debug('file path: {}'.format(models.file_path))
+    if preload and preload not in ('0', 'false', 'no'):
+        views.preload(feature_model=(preload == 'all'))
     return app
 
 
 @click.group(cls=CustomFlaskGroup, create_app=create_app)
-def cli():
+@click.option('--profile', is_flag=True, help='Print the time spent in every stage on exit.')
+@click.pass_context
+def cli(ctx, profile=False):
     """Illustration2Vec."""
-    pass
+    if profile:
+        ctx.call_on_close(lambda: click.echo(metrics.summary(), err=True))
 
 
 @cli.command()
-@click.option('--output', help='Output format;[default]/pprint', default='default')
+@click.option('--output', help='Output format;[default]/pprint/jsonl', default='default')
+@click.option('--batch-size', help='Number of images tagged per forward pass.', default=16)
+@click.option('--workers', help='Number of threads reading and resizing images.', default=4)
+@click.option('--cache/--no-cache', help='Reuse the results of images tagged before.', default=True)
 @click.argument('images', nargs=-1)
-def estimate_plausible_tags(images, output='default'):
+def estimate_plausible_tags(images, output='default', batch_size=16, workers=4, cache=True):
     """Estimate plausible tags."""
-    illust2vec = make_i2v_with_chainer(
-        "illust2vec_tag_ver200.caffemodel", "tag_list.json")
-    image_sets = map(lambda x: {'value': x, 'sha256': models.sha256_checksum(x)}, images)
-    for idx, img_set in enumerate(image_sets):
-        img = Image.open(img_set['value'])
-        res = illust2vec.estimate_plausible_tags([img], threshold=0.5)
-        if isinstance(res[idx]['rating'], zip):
-            res[idx]['rating'] = list(res[idx]['rating'])
-        print("image: {}\nsha256: {}".format(
-            img_set['value'], img_set['sha256']))
+    model_path = "illust2vec_tag_ver200.caffemodel"
+    precision = views.model_precision()
+    illust2vec = make_i2v_with_chainer(model_path, "tag_list.json", precision=precision)
+    if cache:
+        illust2vec.prediction_cache = store.PredictionCache(
+            store.default_prediction_cache_dir(model_path, precision))
+    results = pipeline.iter_plausible_tags(
+        illust2vec, images, batch_size=batch_size, workers=workers, threshold=0.5)
+    for res in results:
+        if output == 'jsonl':
+            print(json.dumps(res), flush=True)
+            continue
+        print("image: {}".format(res['image']))
+        if 'error' in res:
+            print("error: {}".format(res['error']))
+            continue
+        print("sha256: {}".format(res['sha256']))
         if output == 'pprint':
-            pprint(res)
+            pprint([res['tags']])
         else:
-            print(res)
+            print([res['tags']])
+
+
+@cli.command()
+@click.option('--batch-size', help='Number of images per forward pass.', default=16)
+@click.option('--n-lists', help='Train the float feature index with this many lists.', default=0)
+def index_features(batch_size=16, n_lists=0):
+    """Add the features of stored images to the similarity indexes."""
+    binary_index = views.get_binary_index()
+    feature_index = views.get_feature_index()
+    # the first image of every checksum, in one query
+    query = models.db.session.query(models.Checksum.value, models.Image.path) \
+        .join(models.Image, models.Image.checksum_id == models.Checksum.id) \
+        .order_by(models.Checksum.id, models.Image.id)
+    pending = {}
+    for value, path in query:
+        if value not in pending and (
+                value not in binary_index or value not in feature_index):
+            pending[value] = op.join(models.file_path, path)
+    pending = list(pending.items())
+    if pending:
+        illust2vec = views.get_feature_model()
+    outputs = ('feature', 'binary_feature')
+    indexed = 0
+    for start in range(0, len(pending), batch_size):
+        batch = pending[start:start + batch_size]
+        try:
+            results = [(
+                [key for key, _ in batch],
+                illust2vec.extract(
+                    [path for _, path in batch], outputs=outputs, batch_size=batch_size))]
+        except Exception:
+            # find the images that cannot be read and skip them
+            results = []
+            for key, path in batch:
+                try:
+                    results.append(([key], illust2vec.extract([path], outputs=outputs)))
+                except Exception as err:
+                    logger.warning('Failed to index image.', path=path, error=str(err))
+        for keys, features in results:
+            binary_index.add(keys, features['binary_feature'])
+            feature_index.add(keys, features['feature'])
+            indexed += len(keys)
+    print("indexed: {}, failed: {}, total: {}".format(
+        indexed, len(pending) - indexed, len(feature_index)))
+    if n_lists:
+        feature_index.train(n_lists=n_lists)
+        print("trained lists: {}".format(n_lists))
+
+
+@cli.command('import')
+@click.option('--manifest', type=click.File('r'),
+              help='File listing one image path per line ("-" for stdin).')
+@click.option('--link', is_flag=True, help='Hardlink the files instead of copying them.')
+@click.option('--workers', help='Threads hashing and copying files.', type=int)
+@click.option('--processes', help='Processes generating thumbnails.', type=int)
+@click.option('--batch-size', help='Number of files inserted per transaction.', default=1000)
+@click.option('--tag', 'mode', help='Queue tagging jobs of this mode for the imported images.',
+              type=click.Choice([mode for mode, _ in models.TagEstimation.MODES]))
+@click.argument('directories', nargs=-1, type=click.Path(exists=True, file_okay=False))
+def import_images(directories, manifest=None, link=False, workers=None, processes=None,
+                  batch_size=1000, mode=None):
+    """Import the images of directories or of a manifest."""
+    paths = itertools.chain.from_iterable(
+        importer.iter_directory(directory) for directory in directories)
+    if manifest is not None:
+        paths = itertools.chain(paths, importer.iter_manifest(manifest))
+    counts = importer.import_images(
+        paths, link=link, workers=workers, processes=processes, batch_size=batch_size,
+        mode=mode)
+    print("imported: {imported}, skipped: {skipped}, failed: {failed}".format(**counts))
+
+
+@cli.command('worker')
+@click.option('--batch-size', help='Number of jobs claimed and tagged together.', default=16)
+@click.option('--poll-interval', help='Seconds to wait when no job is pending.', default=1.0)
+@click.option('--stale-after', help='Seconds after which running jobs are claimed again.', default=600)
+@click.option('--once', is_flag=True, help='Exit when no job is pending.')
+def run_worker(batch_size=16, poll_interval=1.0, stale_after=600, once=False):
+    """Process queued tag estimation jobs."""
+    processed = worker.run_worker(
+        views.get_illust2vec(), batch_size=batch_size, poll_interval=poll_interval,
+        stale_after=stale_after, once=once)
+    print("processed: {}".format(processed))
+
+
+@cli.command()
+@click.option('--k', help='Number of similar images.', default=10)
+@click.option('--feature', help='Feature to compare;[binary]/float', default='binary')
+@click.option('--n-probe', help='Lists searched in a trained float index.', type=int)
+@click.argument('images', nargs=-1)
+def similar(images, k=10, feature='binary', n_probe=None):
+    """Find stored images similar to the given images."""
+    illust2vec = views.get_feature_model()
+    if feature == 'float':
+        results = views.get_feature_index().search(
+            illust2vec.extract_feature(images), k=k, n_probe=n_probe)
+    else:
+        results = views.get_binary_index().search(
+            illust2vec.extract_binary_feature(images), k=k)
+    for image, result in zip(images, results):
+        print("image: {}".format(image))
+        for value, distance in result:
+            print("{} {}".format(distance, value))
 
 
 if __name__ == '__main__':
@@ -1,5 +1,122 @@
 from abc import ABCMeta, abstractmethod
+import io
+import itertools
+import os
+from appdirs import user_cache_dir
 import numpy as np
+from PIL import Image
+
+from i2v import metrics
+
+# (name, start, stop) of the tag categories in the output of the tag model
+TAG_BLOCKS = (
+    ('general', 0, 512),
+    ('character', 512, 1024),
+    ('copyright', 1024, 1536),
+    ('rating', 1536, 1539),
+)
+# threshold rules matching the columns of the threshold array
+FSCORE_RULES = ('f0.5', 'f1', 'f2')
+# size of the output of the feature model
+FEATURE_DIM = 4096
+# outputs of extract() -> layer they are computed from
+OUTPUT_LAYERS = {'prob': 'prob', 'feature': 'encode1', 'binary_feature': 'encode1'}
+
+
+def _sorted_top_k(arr, k):
+    """Return the column indices of the ``k`` largest values of each row.
+
+    The indices of every row are sorted by descending value.
+    """
+    k = max(0, min(k, arr.shape[1]))
+    if k == 0:
+        return np.empty((arr.shape[0], 0), dtype=np.intp)
+    if k < arr.shape[1]:
+        arg = np.argpartition(-arr, k - 1, axis=1)[:, :k]
+    else:
+        arg = np.broadcast_to(np.arange(arr.shape[1]), arr.shape)
+    rows = np.arange(arr.shape[0])[:, np.newaxis]
+    order = np.argsort(-arr[rows, arg], axis=1)
+    return arg[rows, order]
+
+
+def _concatenate(batches, width, dtype=np.float32):
+    """Stack the rows of ``batches``, or return no row of ``width`` columns."""
+    if not batches:
+        return np.empty((0, width), dtype=dtype)
+    return np.concatenate(batches)
+
+
+def _binarize(feature):
+    """Pack the signs of float features into binary features."""
+    return np.packbits(feature > 0, axis=1)
+
+
+def default_cache_dir():
+    return os.getenv('ILLUSTRATION2VEC_CACHE_DIR') or \
+        user_cache_dir('Illustration2Vec', 'Masaki Saito')
+
+
+def open_image(image, draft_size=None):
+    """Open ``image`` if it is a file path or the content of an image file.
+
+    Other objects are returned unchanged. When ``draft_size`` is given, JPEG
+    files are decoded at the smallest scale that is at least that large.
+    """
+    if isinstance(image, bytes):
+        image = Image.open(io.BytesIO(image))
+    elif isinstance(image, str):
+        image = Image.open(image)
+    else:
+        return image
+    if draft_size is not None:
+        image.draft(image.mode, draft_size)
+    return image
+
+
+class TagPrediction(object):
+    """Tag probabilities of a batch of images.
+
+    Every tag view is computed from the stored probability matrix, so they
+    can be asked for any number of times without running the network again.
+    """
+
+    def __init__(self, model, prob):
+        self.model = model
+        self.prob = prob
+
+    def __len__(self):
+        return self.prob.shape[0]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield TagPrediction(self.model, self.prob[i:i + 1])
+
+    def specific_tags(self, tags):
+        with metrics.timed('postprocess', len(self)):
+            values = self.prob[:, [self.model.index[t] for t in tags]].tolist()
+            return [dict(zip(tags, row)) for row in values]
+
+    def top_tags(self, n_tag=10):
+        with metrics.timed('postprocess', len(self)):
+            return self.model._top_tags(self.prob, n_tag=n_tag)
+
+    def plausible_tags(self, threshold=0.25, threshold_rule='constant'):
+        with metrics.timed('postprocess', len(self)):
+            return self.model._plausible_tags(
+                self.prob, threshold=threshold, threshold_rule=threshold_rule)
+
+    def all_tags(self, n_tag=10, threshold=0.25, threshold_rule='constant'):
+        """Return the union of the plausible tags and the top tags."""
+        plausible = self.plausible_tags(
+            threshold=threshold, threshold_rule=threshold_rule)
+        result = []
+        for res1, res2 in zip(plausible, self.top_tags(n_tag=n_tag)):
+            res = {k: dict(v) for k, v in res1.items()}
+            for main_key, item in res2.items():
+                res[main_key].update(item)
+            result.append({k: list(v.items()) for k, v in res.items()})
+        return result
 
 
 class Illustration2VecBase(object):
@@ -19,10 +136,35 @@ class Illustration2VecBase(object):
         else:
             self.threshold = None
 
+        # optional i2v.preprocess.PreprocessPool used by _prepare_images
+        self.preprocess_pool = None
+        # optional i2v.store.PredictionCache consulted when keys are given
+        self.prediction_cache = None
+        # number of images prepared and run through the network at a time
+        self.batch_size = 16
+
     @abstractmethod
     def _extract(self, inputs, layername):
         pass
 
+    def _extract_many(self, inputs, layernames):
+        """Return the outputs of every layer of ``layernames`` for ``inputs``.
+
+        Backends that can compute several layers in one forward pass
+        override this.
+        """
+        return [self._extract(inputs, layername) for layername in layernames]
+
+    def warm_up(self, layername='prob'):
+        """Run a blank image through the network up to ``layername``.
+
+        The first forward pass is slower than the following ones; call this
+        before serving requests so that no request pays for it.
+        """
+        height, width = getattr(self, 'input_size', (224, 224))
+        self._extract(
+            [np.zeros((height, width, 3), dtype=np.float32)], layername=layername)
+
     def _convert_image(self, image):
         arr = np.asarray(image, dtype=np.float32)
         if arr.ndim == 2:
@@ -36,99 +178,223 @@ class Illustration2VecBase(object):
         else:
             raise TypeError('unsupported image specified')
 
+    def _prepare_image(self, image):
+        """Convert ``image`` to the array passed to ``_extract``."""
+        with metrics.timed('decode'):
+            return self._convert_image(open_image(image))
+
+    def _prepare_images(self, images):
+        if self.preprocess_pool is not None:
+            return self.preprocess_pool.map(images)
+        return [self._prepare_image(img) for img in images]
+
     def _estimate(self, images):
         assert(self.tags is not None)
-        imgs = [self._convert_image(img) for img in images]
+        imgs = self._prepare_images(images)
         prob = self._extract(imgs, layername='prob')
         prob = prob.reshape(prob.shape[0], -1)
         return prob
 
-    def estimate_specific_tags(self, images, tags):
-        prob = self._estimate(images)
-        return [{t: float(prob[i, self.index[t]]) for t in tags}
-                for i in range(prob.shape[0])]
+    def _cached(self, store, compute, images, keys):
+        """Return ``compute(images)``, reusing the rows of ``keys`` in ``store``.
 
-    def estimate_top_tags(self, images, n_tag=10):
-        prob = self._estimate(images)
-        general_prob = prob[:, :512]
-        character_prob = prob[:, 512:1024]
-        copyright_prob = prob[:, 1024:1536]
-        rating_prob = prob[:, 1536:]
-        general_arg = np.argsort(-general_prob, axis=1)[:, :n_tag]
-        character_arg = np.argsort(-character_prob, axis=1)[:, :n_tag]
-        copyright_arg = np.argsort(-copyright_prob, axis=1)[:, :n_tag]
-        rating_arg = np.argsort(-rating_prob, axis=1)
-        result = []
-        for i in range(prob.shape[0]):
-            result.append({
-                'general': list(zip(
-                    self.tags[general_arg[i]],
-                    general_prob[i, general_arg[i]].tolist())),
-                'character': list(zip(
-                    self.tags[512 + character_arg[i]],
-                    character_prob[i, character_arg[i]].tolist())),
-                'copyright': list(zip(
-                    self.tags[1024 + copyright_arg[i]],
-                    copyright_prob[i, copyright_arg[i]].tolist())),
-                'rating': list(zip(
-                    self.tags[1536 + rating_arg[i]],
-                    rating_prob[i, rating_arg[i]].tolist())),
-            })
+        Only the images missing from the store are computed, and their rows
+        are added to it. Without a store or keys everything is computed.
+        """
+        if store is None or keys is None:
+            return compute(images)
+        images, keys = list(images), list(keys)
+        result, found = store.get_many(keys)
+        missing = np.flatnonzero(~found)
+        if len(missing):
+            computed = compute([images[i] for i in missing])
+            result[missing] = computed
+            store.add_many([keys[i] for i in missing], computed)
         return result
 
-    def __extract_plausible_tags(self, preds, f):
-        result = []
-        for pred in preds:
-            general = [(t, p) for t, p in pred['general'] if f(t, p)]
-            character = [(t, p) for t, p in pred['character'] if f(t, p)]
-            copyright = [(t, p) for t, p in pred['copyright'] if f(t, p)]
-            result.append({
-                'general': general,
-                'character': character,
-                'copyright': copyright,
-                'rating': pred['rating'],
-            })
+    def _batches(self, images, keys=None, batch_size=None):
+        """Yield ``(images, keys)`` lists of at most ``batch_size`` items.
+
+        ``images`` and ``keys`` may be any iterables; they are only consumed
+        one batch at a time. ``batch_size`` defaults to the attribute.
+        """
+        batch_size = self.batch_size if batch_size is None else batch_size
+        images = iter(images)
+        keys = None if keys is None else iter(keys)
+        while True:
+            batch = list(itertools.islice(images, batch_size))
+            if not batch:
+                return
+            yield batch, None if keys is None else list(itertools.islice(keys, len(batch)))
+
+    def iter_predict(self, images, keys=None, batch_size=None):
+        """Yield a :class:`TagPrediction` for every ``batch_size`` images.
+
+        Only one batch of ``images`` is held in memory at a time, so this
+        accepts generators of any length. ``batch_size`` defaults to the
+        attribute of the same name. See :meth:`predict` for ``keys``.
+        """
+        cache = self.prediction_cache
+        for batch, batch_keys in self._batches(images, keys, batch_size):
+            yield TagPrediction(self, self._cached(
+                cache.prob if cache is not None else None, self._estimate,
+                batch, batch_keys))
+
+    def predict(self, images, keys=None, batch_size=None):
+        """Run the network and return a :class:`TagPrediction` of all images.
+
+        ``keys`` are the sha256 checksums of the images; with a
+        ``prediction_cache`` set, cached images are not run through the
+        network, and need not even be readable. Images are processed in
+        batches of ``batch_size``, by default the attribute of the same name.
+        """
+        n_tags = 0 if self.tags is None else len(self.tags)
+        prob = _concatenate(
+            [prediction.prob
+             for prediction in self.iter_predict(images, keys, batch_size)], n_tags)
+        return TagPrediction(self, prob)
+
+    def estimate_specific_tags(self, images, tags, keys=None):
+        return self.predict(images, keys).specific_tags(tags)
+
+    def estimate_top_tags(self, images, n_tag=10):
+        return self.predict(images).top_tags(n_tag=n_tag)
+
+    def _top_tags(self, prob, n_tag=10):
+        result = [{} for _ in range(prob.shape[0])]
+        for name, start, stop in TAG_BLOCKS:
+            block = prob[:, start:stop]
+            if name == 'rating':
+                arg = _sorted_top_k(block, block.shape[1])
+            else:
+                arg = _sorted_top_k(block, n_tag)
+            tags = self.tags[start + arg]
+            values = block[np.arange(block.shape[0])[:, np.newaxis], arg].tolist()
+            for i, res in enumerate(result):
+                res[name] = list(zip(tags[i], values[i]))
         return result
 
     def estimate_plausible_tags(
             self, images, threshold=0.25, threshold_rule='constant'):
-        preds = self.estimate_top_tags(images, n_tag=512)
-        result = []
-        if threshold_rule == 'constant':
-            return self.__extract_plausible_tags(
-                preds, lambda t, p: p > threshold)
-        elif threshold_rule == 'f0.5':
-            if self.threshold is None:
-                raise TypeError(
-                    'please specify threshold option during init.')
-            return self.__extract_plausible_tags(
-                preds, lambda t, p: p > self.threshold[self.index[t], 0])
-        elif threshold_rule == 'f1':
-            if self.threshold is None:
-                raise TypeError(
-                    'please specify threshold option during init.')
-            return self.__extract_plausible_tags(
-                preds, lambda t, p: p > self.threshold[self.index[t], 1])
-        elif threshold_rule == 'f2':
+        return self.predict(images).plausible_tags(
+            threshold=threshold, threshold_rule=threshold_rule)
+
+    def _plausible_tags(self, prob, threshold=0.25, threshold_rule='constant'):
+        if threshold_rule in FSCORE_RULES:
             if self.threshold is None:
                 raise TypeError(
                     'please specify threshold option during init.')
-            return self.__extract_plausible_tags(
-                preds, lambda t, p: p > self.threshold[self.index[t], 2])
-        else:
+            threshold = self.threshold[:, FSCORE_RULES.index(threshold_rule)]
+        elif threshold_rule != 'constant':
             raise TypeError('unknown rule specified')
+        # only the tags above their threshold are turned into python objects
+        mask = prob > threshold
+        result = []
+        for i in range(prob.shape[0]):
+            res = {}
+            for name, start, stop in TAG_BLOCKS:
+                if name == 'rating':
+                    arg = start + np.argsort(-prob[i, start:stop])
+                else:
+                    arg = start + np.flatnonzero(mask[i, start:stop])
+                    arg = arg[np.argsort(-prob[i, arg])]
+                res[name] = list(zip(self.tags[arg], prob[i, arg].tolist()))
+            result.append(res)
         return result
 
-    def extract_feature(self, images):
-        imgs = [self._convert_image(img) for img in images]
+    def iter_extract_feature(self, images, keys=None, batch_size=None):
+        """Yield the features of every ``batch_size`` images of ``images``."""
+        cache = self.prediction_cache
+        for batch, batch_keys in self._batches(images, keys, batch_size):
+            yield self._cached(
+                cache.feature if cache is not None else None,
+                self._extract_feature, batch, batch_keys)
+
+    def extract_feature(self, images, keys=None, batch_size=None):
+        return _concatenate(
+            list(self.iter_extract_feature(images, keys, batch_size)), FEATURE_DIM)
+
+    def _extract_feature(self, images):
+        imgs = self._prepare_images(images)
         feature = self._extract(imgs, layername='encode1')
         feature = feature.reshape(feature.shape[0], -1)
         return feature
 
-    def extract_binary_feature(self, images):
-        imgs = [self._convert_image(img) for img in images]
-        feature = self._extract(imgs, layername='encode1neuron')
-        feature = feature.reshape(feature.shape[0], -1)
-        binary_feature = np.zeros_like(feature, dtype=np.uint8)
-        binary_feature[feature > 0.5] = 1
-        return np.packbits(binary_feature, axis=1)
+    def iter_extract_binary_feature(self, images, batch_size=None):
+        """Yield the binary features of every ``batch_size`` images."""
+        for batch, _ in self._batches(images, batch_size=batch_size):
+            yield self._extract_binary_feature(batch)
+
+    def extract_binary_feature(self, images, batch_size=None):
+        return _concatenate(
+            list(self.iter_extract_binary_feature(images, batch_size)), FEATURE_DIM // 8,
+            dtype=np.uint8)
+
+    def _extract_binary_feature(self, images):
+        return _binarize(self._extract_feature(images))
+
+    def _extract_outputs(self, images, outputs):
+        imgs = self._prepare_images(images)
+        layernames = list(dict.fromkeys(OUTPUT_LAYERS[name] for name in outputs))
+        values = dict(zip(layernames, self._extract_many(imgs, layernames)))
+        result = {}
+        for name in outputs:
+            value = values[OUTPUT_LAYERS[name]]
+            value = value.reshape(value.shape[0], -1)
+            result[name] = _binarize(value) if name == 'binary_feature' else value
+        return result
+
+    def _cached_outputs(self, images, outputs, keys):
+        """Return ``_extract_outputs()``, reusing the rows cached for ``keys``.
+
+        The binary feature is derived from the cached float feature. Images
+        missing from any of the stores are run through the network once for
+        all outputs.
+        """
+        cache = self.prediction_cache
+        computed = list(dict.fromkeys(
+            'feature' if name == 'binary_feature' else name for name in outputs))
+        stores = {}
+        if cache is not None and keys is not None:
+            stores = {'prob': cache.prob, 'feature': cache.feature}
+        if any(stores.get(name) is None for name in computed):
+            return self._extract_outputs(images, outputs)
+        images, keys = list(images), list(keys)
+        result, found = {}, {}
+        for name in computed:
+            result[name], found[name] = stores[name].get_many(keys)
+        missing = np.flatnonzero(~np.logical_and.reduce(list(found.values())))
+        if len(missing):
+            values = self._extract_outputs([images[i] for i in missing], computed)
+            for name in computed:
+                result[name][missing] = values[name]
+                stores[name].add_many([keys[i] for i in missing], values[name])
+        if 'binary_feature' in outputs:
+            result['binary_feature'] = _binarize(result['feature'])
+        return {name: result[name] for name in outputs}
+
+    def iter_extract(self, images, outputs=('prob', 'feature', 'binary_feature'),
+                     keys=None, batch_size=None):
+        """Yield a dict of ``outputs`` for every ``batch_size`` images.
+
+        ``outputs`` are any of ``'prob'`` (the tag probabilities, as in
+        :class:`TagPrediction`), ``'feature'`` and ``'binary_feature'``.
+        All of them are computed from one forward pass per batch. See
+        :meth:`predict` for ``keys``.
+        """
+        outputs = tuple(outputs)
+        for batch, batch_keys in self._batches(images, keys, batch_size):
+            yield self._cached_outputs(batch, outputs, batch_keys)
+
+    def extract(self, images, outputs=('prob', 'feature', 'binary_feature'), keys=None,
+                batch_size=None):
+        """Return a dict of ``outputs`` of all images; see :meth:`iter_extract`."""
+        batches = list(self.iter_extract(images, outputs, keys, batch_size))
+        widths = {
+            'prob': 0 if self.tags is None else len(self.tags),
+            'feature': FEATURE_DIM, 'binary_feature': FEATURE_DIM // 8}
+        return {
+            name: _concatenate(
+                [batch[name] for batch in batches], widths[name],
+                dtype=np.uint8 if name == 'binary_feature' else np.float32)
+            for name in outputs}
@@ -8,6 +8,9 @@ from caffe.io import resize_image
 class CaffeI2V(Illustration2VecBase):
 
     def _extract(self, inputs, layername):
+        return self._extract_many(inputs, [layername])[0]
+
+    def _extract_many(self, inputs, layernames):
         # NOTE: we import the following codes from caffe.Classifier
         shape = (
             len(inputs), self.net.image_dims[0],
@@ -29,8 +32,8 @@ class CaffeI2V(Illustration2VecBase):
             caffe_in[ix] = \
                 self.net.transformer.preprocess(self.net.inputs[0], in_)
         out = self.net.forward_all(
-            blobs=[layername], **{self.net.inputs[0]: caffe_in})[layername]
-        return out
+            blobs=list(layernames), **{self.net.inputs[0]: caffe_in})
+        return [out[layername] for layername in layernames]
 
 
 def make_i2v_with_caffe(net_path, param_path, tag_path=None, threshold_path=None):
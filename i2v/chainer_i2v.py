@@ -1,13 +1,29 @@
-from i2v.base import Illustration2VecBase
+from i2v import metrics
+from i2v.base import Illustration2VecBase, TagPrediction, default_cache_dir, open_image
+from i2v.checksum import file_sha256
 import json
+import os
+import os.path as op
+import pickle
+import shutil
+import threading
 import warnings
 import numpy as np
+from PIL import Image
 from scipy.ndimage import zoom
 from skimage.transform import resize
 import chainer
 from chainer import Variable
 from chainer.functions import average_pooling_2d, sigmoid
 from chainer.links.caffe import CaffeFunction
+import structlog
+
+
+logger = structlog.getLogger(__name__)
+
+
+# layers computed by ChainerI2V from the output of another layer
+DERIVED_LAYERS = {'prob': 'conv6_4', 'encode1neuron': 'encode1'}
 
 
 class ChainerI2V(Illustration2VecBase):
@@ -16,6 +32,31 @@ class ChainerI2V(Illustration2VecBase):
         super(ChainerI2V, self).__init__(*args, **kwargs)
         mean = np.array([ 164.76139251,  167.47864617,  181.13838569])
         self.mean = mean
+        self.input_size = (224, 224)
+        # tag indices -> conv6_4 weights and biases of those tags only
+        self._specific_weights = {}
+        # sorted output layers -> layers disabled when computing them
+        self._disabled = {}
+
+    def _prepare_image(self, image):
+        height, width = self.input_size
+        if isinstance(image, np.ndarray) and image.shape[:2] == self.input_size:
+            # already prepared, e.g. by the streaming pipeline
+            return self._convert_image(image)
+        with metrics.timed('decode'):
+            # let the JPEG decoder downscale large files while decoding them
+            image = open_image(image, draft_size=(2 * width, 2 * height))
+            if isinstance(image, Image.Image):
+                image.load()
+        with metrics.timed('resize'):
+            if isinstance(image, Image.Image) and image.mode in ('RGB', 'RGBA', 'L'):
+                # resampling the 8-bit image with PIL is much faster than
+                # resizing a float64 copy of it with skimage
+                if image.mode == 'RGBA':
+                    image = image.convert('RGB')
+                image = image.resize((width, height), Image.BILINEAR)
+                return self._convert_image(image)
+            return self.resize_image(self._convert_image(image), self.input_size)
 
     def resize_image(self, im, new_dims, interp_order=1):
         # NOTE: we import the following codes from caffe.io.resize_image()
@@ -39,38 +80,380 @@ class ChainerI2V(Illustration2VecBase):
             resized_im = zoom(im, scale + (1,), order=interp_order)
         return resized_im.astype(np.float32)
 
-    def _forward(self, inputs, layername):
-        shape = [len(inputs), 224, 224, 3]
-        input_ = np.zeros(shape, dtype=np.float32)
+    def _disabled_layers(self, outputs):
+        """Return the layers that do not contribute to any of ``outputs``.
+
+        ``CaffeFunction`` runs every layer whose inputs are available, so
+        asking for ``conv6_4`` would also compute ``encode1`` and vice versa
+        unless the other branch is disabled.
+        """
+        key = tuple(sorted(outputs))
+        disabled = self._disabled.get(key)
+        if disabled is None:
+            blobs, needed = set(outputs), set()
+            for name, bottoms, tops in reversed(self.net.layers):
+                if name in self.net.forwards and blobs.intersection(tops):
+                    needed.add(name)
+                    blobs.update(bottoms)
+            disabled = self._disabled[key] = frozenset(
+                name for name, _, _ in self.net.layers if name not in needed)
+        return disabled
+
+    def _forward(self, inputs, layername, disable=()):
+        return self._forward_many(inputs, [layername], disable=disable)[0]
+
+    def _forward_many(self, inputs, layernames, disable=()):
+        """Return the outputs of ``layernames`` of one forward pass."""
+        height, width = self.input_size
+        input_ = np.empty((len(inputs), 3, height, width), dtype=np.float32)
+        mean = self.mean.reshape(3, 1, 1)
         for ix, in_ in enumerate(inputs):
-            input_[ix] = self.resize_image(in_, shape[1:])
-        input_ = input_[:, :, :, ::-1]  # RGB to BGR
-        input_ -= self.mean  # subtract mean
-        input_ = input_.transpose((0, 3, 1, 2))  # (N, H, W, C) -> (N, C, H, W)
+            if in_.shape[:2] != self.input_size:
+                with metrics.timed('resize'):
+                    in_ = self.resize_image(in_, self.input_size)
+            # RGB to BGR, (H, W, C) -> (C, H, W) and mean subtraction in one
+            # pass over the image
+            np.subtract(in_[:, :, ::-1].transpose((2, 0, 1)), mean, out=input_[ix])
         x = Variable(input_)
-        with chainer.using_config('train', False), chainer.using_config('enable_backprop', False):
-            y, = self.net(inputs={'data': x}, outputs=[layername])
-        return y
+        with metrics.timed('forward', len(inputs)), \
+                chainer.using_config('train', False), \
+                chainer.using_config('enable_backprop', False):
+            return self.net(
+                inputs={'data': x}, outputs=layernames,
+                disable=self._disabled_layers(layernames).union(disable))
 
     def _extract(self, inputs, layername):
-        if layername == 'prob':
-            h = self._forward(inputs, layername='conv6_4')
-            h = average_pooling_2d(h, ksize=7)
-            y = sigmoid(h)
-            return y.data
-        elif layername == 'encode1neuron':
-            h = self._forward(inputs, layername='encode1')
-            y = sigmoid(h)
-            return y.data
-        else:
-            y = self._forward(inputs, layername)
-            return y.data
+        return self._extract_many(inputs, [layername])[0]
+
+    def _extract_many(self, inputs, layernames):
+        sources = []
+        for layername in layernames:
+            source = DERIVED_LAYERS.get(layername, layername)
+            if source not in sources:
+                sources.append(source)
+        outputs = dict(zip(sources, self._forward_many(inputs, sources)))
+        result = []
+        for layername in layernames:
+            h = outputs[DERIVED_LAYERS.get(layername, layername)]
+            if layername == 'prob':
+                h = sigmoid(average_pooling_2d(h, ksize=7))
+            elif layername == 'encode1neuron':
+                h = sigmoid(h)
+            result.append(h.array)
+        return result
+
+    def estimate_specific_tags(self, images, tags, keys=None):
+        """Return the probabilities of ``tags`` only.
+
+        The network is run up to the input of ``conv6_4``, and only the
+        output channels of ``tags`` are computed from it, which skips almost
+        all of the work of the last layer when few tags are asked for. The
+        sliced weights are kept for every set of tags. With ``keys`` and a
+        ``prediction_cache``, the probabilities of all tags are read from the
+        cache, and those of missing images computed and added to it, as in
+        :meth:`predict`.
+        """
+        indices = tuple(self.index[t] for t in tags)
+        cache = self.prediction_cache
+        result = []
+        for batch, batch_keys in self._batches(images, keys):
+            if cache is not None and batch_keys is not None:
+                prediction = TagPrediction(
+                    self, self._cached(cache.prob, self._estimate, batch, batch_keys))
+                result.extend(prediction.specific_tags(tags))
+                continue
+            prob = self._extract_specific(self._prepare_images(batch), indices)
+            with metrics.timed('postprocess', len(batch)):
+                result.extend(dict(zip(tags, row)) for row in prob.tolist())
+        return result
+
+    def _extract_specific(self, inputs, indices):
+        link = self.net['conv6_4']
+        bottom = next(bottoms[0] for name, bottoms, _ in self.net.layers if name == 'conv6_4')
+        weights = self._specific_weights.get(indices)
+        if weights is None:
+            index = np.array(indices, dtype=np.intp)
+            W = _param_array(self.net, 'conv6_4', 'W')
+            weights = self._specific_weights[indices] = (
+                np.ascontiguousarray(W[index]),
+                None if link.b is None else np.ascontiguousarray(link.b.array[index]))
+        h = self._forward(inputs, layername=bottom)
+        kh, kw = weights[0].shape[2:]
+        ph, pw = link.pad
+        out_h, out_w = h.shape[2] + 2 * ph - kh + 1, h.shape[3] + 2 * pw - kw + 1
+        if tuple(link.stride) != (1, 1) or (out_h, out_w) != (7, 7) or \
+                tuple(getattr(link, 'dilate', (1, 1))) != (1, 1) or \
+                getattr(link, 'groups', 1) != 1:
+            # not the layer the shortcut below assumes; finish the full pass
+            with metrics.timed('forward', len(inputs)), \
+                    chainer.using_config('train', False), \
+                    chainer.using_config('enable_backprop', False):
+                h = self.net.forwards['conv6_4'](h)
+                h = sigmoid(average_pooling_2d(h, ksize=7)).array
+            return h.reshape(h.shape[0], -1)[:, list(indices)]
+        # the pooling averages the whole 7x7 output of the stride 1
+        # convolution, which is linear, so the weights can be applied once to
+        # the mean of the input windows instead of to every window
+        h = np.pad(h.array, ((0, 0), (0, 0), (ph, ph), (pw, pw)), mode='constant')
+        window = np.empty(h.shape[:2] + (kh, kw), dtype=h.dtype)
+        for i in range(kh):
+            for j in range(kw):
+                window[:, :, i, j] = h[:, :, i:i + out_h, j:j + out_w].mean(axis=(2, 3))
+        h = np.tensordot(window, weights[0], axes=([1, 2, 3], [1, 2, 3]))
+        if weights[1] is not None:
+            h += weights[1]
+        return sigmoid(h).array
+
+
+PRECISIONS = ('float32', 'float16', 'int8')
+
+
+def _quantize(array, precision):
+    """Return the ``(data, scale)`` stored for ``array`` in ``precision``."""
+    if precision == 'float16':
+        return array.astype(np.float16), None
+    # symmetric int8 with one scale per output channel
+    absmax = np.abs(array.reshape(array.shape[0], -1)).max(axis=1)
+    scale = (np.maximum(absmax, 1e-12) / 127).astype(np.float32)
+    scale = scale.reshape((-1,) + (1,) * (array.ndim - 1))
+    data = np.clip(np.rint(array / scale), -127, 127).astype(np.int8)
+    return data, scale
+
+
+def _dequantize(data, scale):
+    if scale is None:
+        return data.astype(np.float32)
+    return data.astype(np.float32) * scale
+
+
+class _DequantizedCall(object):
+    """Call a layer of a ``CaffeFunction`` whose weights are stored quantized.
+
+    Replaces the layer's entry in ``forwards``. The float32 weights only
+    exist while at least one call of the layer is running, so at most a few
+    layers are dequantized at any time.
+    """
+
+    def __init__(self, caffe_func, name, weights):
+        self.caffe_func = caffe_func
+        self.name = name
+        # parameter name -> (data, scale)
+        self.weights = weights
+        self._lock = threading.Lock()
+        self._users = 0
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_lock'], state['_users']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+        self._users = 0
+
+    def array(self, name):
+        """Return the float32 value of parameter ``name``."""
+        return _dequantize(*self.weights[name])
+
+    def __call__(self, *xs, **kwargs):
+        link = self.caffe_func[self.name]
+        with self._lock:
+            if not self._users:
+                for name in self.weights:
+                    getattr(link, name).array = self.array(name)
+            self._users += 1
+        try:
+            return link(*xs, **kwargs)
+        finally:
+            with self._lock:
+                self._users -= 1
+                if not self._users:
+                    for name in self.weights:
+                        getattr(link, name).array = None
+
+
+def quantize_caffe_function(net, precision):
+    """Store the weights of ``net`` in ``precision`` (``'float16'`` or ``'int8'``).
+
+    Only weights with two or more dimensions are converted; biases stay in
+    float32. Inference still computes in float32: every layer dequantizes
+    its weights when it is called and drops them afterwards.
+    """
+    if precision not in PRECISIONS[1:]:
+        raise ValueError('unknown precision: {}'.format(precision))
+    for name, _, _ in net.layers:
+        if name not in net.forwards or name not in net._children:
+            continue
+        link = net[name]
+        weights = {}
+        for param_name, param in link.namedparams():
+            if param.array is not None and param.array.ndim >= 2:
+                param_name = param_name.strip('/')
+                weights[param_name] = _quantize(param.array, precision)
+                param.array = None
+        if weights:
+            net.forwards[name] = _DequantizedCall(net, name, weights)
+    return net
+
+
+def _param_array(net, layer, name):
+    """Return parameter ``name`` of ``layer`` as a float32 array."""
+    forward = net.forwards.get(layer)
+    if isinstance(forward, _DequantizedCall) and name in forward.weights:
+        return forward.array(name)
+    return getattr(net[layer], name).array
+
+
+class _SnapshotPickler(pickle.Pickler):
+    """Pickler storing the listed arrays as references to ``.npy`` files."""
+
+    def __init__(self, file, filenames):
+        super(_SnapshotPickler, self).__init__(
+            file, protocol=pickle.HIGHEST_PROTOCOL)
+        self.filenames = filenames
+
+    def persistent_id(self, obj):
+        if isinstance(obj, np.ndarray):
+            return self.filenames.get(id(obj))
+        return None
+
+
+class _SnapshotUnpickler(pickle.Unpickler):
+
+    def __init__(self, file, path, mmap_mode=None):
+        super(_SnapshotUnpickler, self).__init__(file)
+        self.path = path
+        self.mmap_mode = mmap_mode
+
+    def persistent_load(self, pid):
+        return np.load(op.join(self.path, pid), mmap_mode=self.mmap_mode)
+
+
+def save_snapshot(net, path):
+    """Save ``net`` to the ``path`` directory.
+
+    Every parameter, and every weight quantized by
+    :func:`quantize_caffe_function`, is written to its own ``.npy`` file and
+    the rest of the network is pickled to ``net.pkl`` so it can be rebuilt
+    without parsing the caffemodel again. The files are written and synced
+    in a temporary directory that is then renamed to ``path``, so a crash
+    never leaves a partial snapshot at ``path``.
+    """
+    tmp_path = '{}.tmp{}'.format(path, os.getpid())
+    os.makedirs(tmp_path)
+    try:
+        arrays = [
+            (name.strip('/').replace('/', '.'), param.array)
+            for name, param in net.namedparams() if param.array is not None]
+        for layer, forward in net.forwards.items():
+            if isinstance(forward, _DequantizedCall):
+                for name, (data, scale) in forward.weights.items():
+                    arrays.append(('{}.{}.data'.format(layer, name), data))
+                    if scale is not None:
+                        arrays.append(('{}.{}.scale'.format(layer, name), scale))
+        filenames = {}
+        for name, array in arrays:
+            filename = name + '.npy'
+            with open(op.join(tmp_path, filename), 'wb') as f:
+                np.save(f, array)
+                f.flush()
+                os.fsync(f.fileno())
+            filenames[id(array)] = filename
+        with open(op.join(tmp_path, 'net.pkl'), 'wb') as f:
+            _SnapshotPickler(f, filenames).dump(net)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp_path, path)
+    except OSError:
+        # another process may have written the same snapshot first
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        if not op.isdir(path):
+            raise
+
+
+def load_snapshot(path, mmap_mode=None):
+    """Load a network saved by :func:`save_snapshot`.
+
+    ``mmap_mode`` is passed to :func:`numpy.load` for every parameter.
+    """
+    with open(op.join(path, 'net.pkl'), 'rb') as f:
+        return _SnapshotUnpickler(f, path, mmap_mode=mmap_mode).load()
+
+
+def _load_valid_snapshot(path, mmap_mode=None):
+    """Return the snapshot at ``path``, or None if there is no usable one.
+
+    A snapshot that cannot be loaded, e.g. a truncated one or one pickled by
+    other versions of chainer or numpy, is removed so that it is converted
+    again from the caffemodel.
+    """
+    if not op.isdir(path):
+        return None
+    try:
+        return load_snapshot(path, mmap_mode=mmap_mode)
+    except Exception as err:
+        logger.warning('Discarding unreadable snapshot.', path=path, error=repr(err))
+        shutil.rmtree(path, ignore_errors=True)
+        return None
+
+
+def load_caffe_function(param_path, cache_dir=None, snapshot=True, mmap_mode=None,
+                        precision='float32'):
+    """Load the caffemodel at ``param_path`` as a ``CaffeFunction``.
+
+    With ``snapshot`` enabled the converted network is saved under
+    ``cache_dir`` on first use, keyed by the sha256 of the caffemodel, and
+    later calls load it from there. ``mmap_mode`` is then used to load the
+    parameters; with ``'r'`` every process loading the same snapshot shares
+    one read-only copy of the weights through the page cache.
+
+    ``precision`` ``'float16'`` or ``'int8'`` stores the weights in that
+    precision (see :func:`quantize_caffe_function`), in a snapshot of its own.
+    """
+    if precision not in PRECISIONS:
+        raise ValueError('unknown precision: {}'.format(precision))
+    if snapshot:
+        cache_dir = default_cache_dir() if cache_dir is None else cache_dir
+        name = file_sha256(param_path)
+        if precision != 'float32':
+            name = '{}-{}'.format(name, precision)
+        path = op.join(cache_dir, 'snapshots', name)
+        net = _load_valid_snapshot(path, mmap_mode=mmap_mode)
+        if net is not None:
+            return net
+        if precision != 'float32':
+            net = load_caffe_function(param_path, cache_dir=cache_dir)
+            quantize_caffe_function(net, precision)
+            save_snapshot(net, path)
+            return net if mmap_mode is None else load_snapshot(path, mmap_mode=mmap_mode)
 
-def make_i2v_with_chainer(param_path, tag_path=None, threshold_path=None):
     # ignore UserWarnings from chainer
     with warnings.catch_warnings():
         warnings.simplefilter('ignore')
         net = CaffeFunction(param_path)
+    # inference never needs gradients, and the initializers keep a copy of
+    # every caffe blob alive
+    net.cleargrads()
+    for param in net.params():
+        param.initializer = None
+    if precision != 'float32':
+        quantize_caffe_function(net, precision)
+
+    if snapshot:
+        os.makedirs(op.dirname(path), exist_ok=True)
+        save_snapshot(net, path)
+        if mmap_mode is not None:
+            net = load_snapshot(path, mmap_mode=mmap_mode)
+    return net
+
+
+def make_i2v_with_chainer(param_path, tag_path=None, threshold_path=None,
+                          cache_dir=None, snapshot=True, mmap_mode=None,
+                          precision='float32'):
+    net = load_caffe_function(
+        param_path, cache_dir=cache_dir, snapshot=snapshot, mmap_mode=mmap_mode,
+        precision=precision)
 
     kwargs = {}
     if tag_path is not None:
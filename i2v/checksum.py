@@ -0,0 +1,99 @@
+"""sha256 checksums of image files.
+
+Files of at least ``MMAP_THRESHOLD`` bytes are hashed from a memory map,
+smaller ones with large reads. hashlib releases the GIL while hashing, so
+:func:`file_sha256_many` hashes several files at once on a thread pool.
+Digests are remembered by path, size, modification time and inode, so an
+unchanged file is only hashed once per process.
+"""
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import mmap
+import os
+import os.path as op
+import threading
+
+
+BLOCK_SIZE = 1 << 20
+MMAP_THRESHOLD = 1 << 22
+
+
+class ChecksumCache(object):
+    """Digests of the most recently hashed files, by file identity."""
+
+    def __init__(self, max_size=65536):
+        self.max_size = max_size
+        self._digests = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            digest = self._digests.get(key)
+            if digest is not None:
+                self._digests.move_to_end(key)
+            return digest
+
+    def set(self, key, digest):
+        with self._lock:
+            self._digests[key] = digest
+            self._digests.move_to_end(key)
+            while len(self._digests) > self.max_size:
+                self._digests.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._digests.clear()
+
+
+CACHE = ChecksumCache()
+
+
+def _file_key(filename, stat):
+    return (op.abspath(filename), stat.st_size, stat.st_mtime_ns, stat.st_ino, stat.st_dev)
+
+
+def _hash_file(f, size):
+    sha256 = hashlib.sha256()
+    if size >= MMAP_THRESHOLD:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            sha256.update(mapped)
+        return sha256.hexdigest()
+    buf = bytearray(min(BLOCK_SIZE, max(size, 1)))
+    view = memoryview(buf)
+    while True:
+        n = f.readinto(buf)
+        if not n:
+            break
+        sha256.update(view[:n])
+    return sha256.hexdigest()
+
+
+def file_sha256(filename, cache=CACHE):
+    """Return the hex sha256 digest of the content of ``filename``.
+
+    Pass ``cache=None`` to always read the file.
+    """
+    with open(filename, 'rb') as f:
+        stat = os.fstat(f.fileno())
+        key = _file_key(filename, stat)
+        digest = None if cache is None else cache.get(key)
+        if digest is None:
+            digest = _hash_file(f, stat.st_size)
+            if cache is not None:
+                cache.set(key, digest)
+    return digest
+
+
+def file_sha256_many(filenames, workers=None, cache=CACHE):
+    """Return the digests of ``filenames``, hashing ``workers`` files at once.
+
+    ``workers`` defaults to the number of CPUs. Errors, e.g. of missing
+    files, are raised when their digest is reached.
+    """
+    filenames = list(filenames)
+    workers = (os.cpu_count() or 1) if workers is None else workers
+    if workers <= 1 or len(filenames) <= 1:
+        return [file_sha256(filename, cache=cache) for filename in filenames]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(lambda filename: file_sha256(filename, cache=cache), filenames))
@@ -0,0 +1,212 @@
+"""Bulk import of image files into the database.
+
+``i2v import`` adds the images of directory trees, or of a manifest listing
+one path per line, as :class:`i2v.models.Image` rows. Files are hashed on a
+thread pool, and checksums that already have an image are skipped. The
+thumbnails of the new files are generated on a process pool, which also
+checks that they are images. New files are then copied or hardlinked into
+:data:`i2v.models.file_path` under the name the upload form gives them,
+``<checksum><ext>``. The rows of each batch are inserted in one transaction.
+"""
+from concurrent.futures import ThreadPoolExecutor
+import itertools
+import multiprocessing
+import os
+import os.path as op
+import shutil
+
+from flask_admin import form
+from PIL import Image, ImageOps
+import structlog
+
+from . import checksum, metrics, models
+
+
+logger = structlog.getLogger(__name__)
+
+IMAGE_EXTENSIONS = ('.bmp', '.gif', '.jpeg', '.jpg', '.png', '.webp')
+# size of the thumbnails made by the upload form
+THUMBNAIL_SIZE = (100, 100)
+# maximum number of values in one IN clause
+_QUERY_CHUNK = 500
+
+
+def iter_directory(directory):
+    """Yield the paths of the image files under ``directory``, sorted."""
+    for root, dirs, files in os.walk(directory):
+        dirs.sort()
+        for name in sorted(files):
+            if op.splitext(name)[1].lower() in IMAGE_EXTENSIONS:
+                yield op.join(root, name)
+
+
+def iter_manifest(lines):
+    """Yield the paths listed in ``lines``, skipping blank and ``#`` lines."""
+    for line in lines:
+        line = line.strip()
+        if line and not line.startswith('#'):
+            yield line
+
+
+def _hash(path):
+    try:
+        return checksum.file_sha256(path)
+    except OSError as err:
+        return err
+
+
+def _make_thumbnail(args):
+    """Write the thumbnail of an image file and return the extension to store it with.
+
+    The file is stored as is, so its thumbnail keeps its format, and both
+    get the extension of that format (``.jpg`` for JPEG files). Returns the
+    exception if the file is not an image.
+    """
+    path, value, directory = args
+    try:
+        with Image.open(path) as image:
+            if image.format in ('JPEG', 'MPO'):
+                ext, fmt = '.jpg', 'JPEG'
+            elif image.format == 'PNG':
+                ext, fmt = '.png', 'PNG'
+            elif image.format in Image.SAVE:
+                ext, fmt = op.splitext(path)[1].lower(), image.format
+            else:
+                raise ValueError('cannot write {} thumbnails'.format(image.format))
+            image.draft('RGB', (2 * THUMBNAIL_SIZE[0], 2 * THUMBNAIL_SIZE[1]))
+            thumbnail = image
+            if image.size[0] > THUMBNAIL_SIZE[0] or image.size[1] > THUMBNAIL_SIZE[1]:
+                thumbnail = ImageOps.fit(image, THUMBNAIL_SIZE, Image.LANCZOS)
+            if fmt == 'JPEG' and thumbnail.mode != 'RGB':
+                thumbnail = thumbnail.convert('RGB')
+            elif thumbnail.mode not in ('RGB', 'RGBA'):
+                thumbnail = thumbnail.convert('RGBA')
+            thumbnail.save(op.join(directory, form.thumbgen_filename(value + ext)), fmt)
+        return ext
+    except Exception as err:
+        return err
+
+
+def _store(path, dest, link):
+    """Copy or hardlink ``path`` to ``dest``; return the exception if it fails."""
+    if op.exists(dest):
+        return
+    if link:
+        try:
+            os.link(path, dest)
+            return
+        except OSError:
+            # e.g. another file system; fall back to a copy
+            pass
+    tmp = '{}.tmp{}'.format(dest, os.getpid())
+    try:
+        shutil.copyfile(path, tmp)
+        os.replace(tmp, dest)
+    except OSError as err:
+        if op.exists(tmp):
+            os.remove(tmp)
+        return err
+
+
+def _existing_checksums(values, session):
+    """Return ``{value: (checksum id, has image)}`` of the stored ``values``."""
+    result = {}
+    values = list(values)
+    for start in range(0, len(values), _QUERY_CHUNK):
+        chunk = values[start:start + _QUERY_CHUNK]
+        query = session.query(models.Checksum.id, models.Checksum.value, models.Image.id) \
+            .outerjoin(models.Image, models.Image.checksum_id == models.Checksum.id) \
+            .filter(models.Checksum.value.in_(chunk))
+        for c_id, value, i_id in query:
+            result[value] = (c_id, result.get(value, (c_id, False))[1] or i_id is not None)
+    return result
+
+
+def _insert(new, session, mode=None):
+    """Insert the ``{value: (checksum id or None, path)}`` images and commit."""
+    checksum_table = models.Checksum.__table__
+    missing = [value for value, (c_id, _) in new.items() if c_id is None]
+    if missing:
+        session.execute(checksum_table.insert(), [{'value': value} for value in missing])
+        ids = {
+            value: c_id for value, (c_id, _) in _existing_checksums(missing, session).items()}
+        new = {
+            value: (ids.get(value, c_id), path) for value, (c_id, path) in new.items()}
+    session.execute(models.Image.__table__.insert(), [
+        {'path': path, 'checksum_id': c_id} for c_id, path in new.values()])
+    if mode is not None:
+        session.execute(models.TagJob.__table__.insert(), [
+            {'checksum_id': c_id, 'mode': mode, 'status': models.JOB_PENDING}
+            for c_id, _ in new.values()])
+    session.commit()
+
+
+def import_images(paths, link=False, workers=None, processes=None, batch_size=1000,
+                  mode=None, session=None):
+    """Import the image files ``paths``.
+
+    ``workers`` threads hash and store the files and ``processes`` processes
+    make the thumbnails (both default to the number of CPUs). With ``mode``,
+    a tagging job of that mode is queued for every imported image. Returns
+    a dictionary with the number of ``imported``, ``skipped`` (duplicate)
+    and ``failed`` files.
+    """
+    session = models.db.session if session is None else session
+    workers = workers or os.cpu_count() or 1
+    os.makedirs(models.file_path, exist_ok=True)
+    counts = {'imported': 0, 'skipped': 0, 'failed': 0}
+    paths = iter(paths)
+    with ThreadPoolExecutor(max_workers=workers) as executor, \
+            multiprocessing.Pool(processes) as pool:
+        while True:
+            batch = list(itertools.islice(paths, batch_size))
+            if not batch:
+                return counts
+            with metrics.timed('checksum', len(batch)):
+                digests = list(executor.map(_hash, batch))
+            unique = {}
+            for path, digest in zip(batch, digests):
+                if isinstance(digest, Exception):
+                    logger.warning('Failed to read file.', path=path, error=str(digest))
+                    counts['failed'] += 1
+                elif digest in unique:
+                    counts['skipped'] += 1
+                else:
+                    unique[digest] = path
+            existing = _existing_checksums(unique, session)
+            pending = []
+            for value, path in unique.items():
+                c_id, has_image = existing.get(value, (None, False))
+                if has_image:
+                    counts['skipped'] += 1
+                else:
+                    pending.append((value, path, c_id))
+            exts = pool.map(
+                _make_thumbnail,
+                [(path, value, models.file_path) for value, path, _ in pending])
+            new = {}
+            for (value, path, c_id), ext in zip(pending, exts):
+                if isinstance(ext, Exception):
+                    logger.warning('Failed to read image.', path=path, error=str(ext))
+                    counts['failed'] += 1
+                    continue
+                new[value] = (c_id, value + ext)
+            names = {value: name for value, (_, name) in new.items()}
+            errors = list(executor.map(
+                lambda value: _store(
+                    unique[value], op.join(models.file_path, names[value]), link),
+                names))
+            for value, err in zip(names, errors):
+                if err is not None:
+                    logger.warning('Failed to store file.', path=unique[value], error=str(err))
+                    thumbnail = op.join(
+                        models.file_path, form.thumbgen_filename(names[value]))
+                    if op.exists(thumbnail):
+                        os.remove(thumbnail)
+                    del new[value]
+                    counts['failed'] += 1
+            if new:
+                with metrics.timed('db_write', len(new)):
+                    _insert(new, session, mode=mode)
+            counts['imported'] += len(new)
+            logger.info('Batch imported.', **counts)
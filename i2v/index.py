@@ -0,0 +1,294 @@
+"""Similarity search over the feature vectors of stored images."""
+import io
+import os
+import os.path as op
+import threading
+import uuid
+
+from appdirs import user_data_dir
+import numpy as np
+
+from i2v.base import _sorted_top_k
+from i2v.store import VectorStore, file_lock
+
+
+def default_index_dir():
+    return os.getenv('ILLUSTRATION2VEC_INDEX_DIR') or \
+        op.join(user_data_dir('Illustration2Vec', 'Masaki Saito'), 'index')
+
+
+def _popcount(arr):
+    """Return the number of set bits of every element of a uint64 array."""
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(arr)
+    arr = arr - ((arr >> np.uint64(1)) & np.uint64(0x5555555555555555))
+    arr = (arr & np.uint64(0x3333333333333333)) + \
+        ((arr >> np.uint64(2)) & np.uint64(0x3333333333333333))
+    arr = (arr + (arr >> np.uint64(4))) & np.uint64(0x0f0f0f0f0f0f0f0f)
+    return (arr * np.uint64(0x0101010101010101)) >> np.uint64(56)
+
+
+def _merge_top_k(best, candidates, k):
+    """Keep the ``k`` smallest (distance, row) pairs of both arguments."""
+    distance = np.concatenate([best[0], candidates[0]], axis=1)
+    rows = np.concatenate([best[1], candidates[1]], axis=1)
+    arg = _sorted_top_k(-distance, k)
+    index = np.arange(distance.shape[0])[:, np.newaxis]
+    return distance[index, arg], rows[index, arg]
+
+
+class BinaryFeatureIndex(object):
+    """Binary features, as returned by ``extract_binary_feature``, by checksum.
+
+    The packed codes are kept in a :class:`i2v.store.VectorStore`, and queries
+    scan them block by block, counting differing bits 64 at a time.
+    """
+
+    def __init__(self, path=None, n_bytes=512):
+        if n_bytes % 8:
+            raise ValueError('n_bytes must be a multiple of 8')
+        self.path = op.join(default_index_dir(), 'binary') if path is None else path
+        self.store = VectorStore(self.path, n_bytes, dtype='uint8')
+
+    def __len__(self):
+        return len(self.store)
+
+    def __contains__(self, key):
+        return key in self.store
+
+    def add(self, keys, codes):
+        self.store.add_many(keys, codes)
+
+    def get(self, key):
+        return self.store.get(key)
+
+    def search(self, codes, k=10, block_size=65536):
+        """Return the ``k`` nearest stored checksums of every code in ``codes``.
+
+        Each result is a list of ``(checksum, hamming distance)`` pairs,
+        nearest first.
+        """
+        codes = np.ascontiguousarray(codes, dtype=np.uint8)
+        queries = codes.reshape(codes.shape[0], -1).view(np.uint64)
+        stored = self.store.vectors()
+        best = (np.empty((len(queries), 0), dtype=np.int64),
+                np.empty((len(queries), 0), dtype=np.int64))
+        for start in range(0, stored.shape[0], block_size):
+            block = np.ascontiguousarray(stored[start:start + block_size]).view(np.uint64)
+            distance = np.empty((len(queries), block.shape[0]), dtype=np.int64)
+            for i, query in enumerate(queries):
+                distance[i] = _popcount(block ^ query).sum(axis=1)
+            rows = np.broadcast_to(
+                np.arange(start, start + block.shape[0]), distance.shape)
+            best = _merge_top_k(best, (distance, rows), k)
+        return [
+            [(self.store.key(row), int(dist)) for dist, row in zip(dists, rows)]
+            for dists, rows in zip(*best)]
+
+
+def _normalize(features):
+    features = np.asarray(features, dtype=np.float32)
+    features = features.reshape(features.shape[0], -1)
+    norm = np.linalg.norm(features, axis=1, keepdims=True)
+    return features / np.maximum(norm, 1e-12)
+
+
+def _nearest_centroid(vectors, centroids):
+    return np.argmax(vectors.dot(centroids.T), axis=1).astype(np.int32)
+
+
+def _replace(path, data):
+    """Write ``data`` to ``path`` atomically, through a temporary file."""
+    tmp = '{}.tmp{}.{}'.format(path, os.getpid(), threading.get_ident())
+    with open(tmp, 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+class FeatureIndex(object):
+    """Float features, as returned by ``extract_feature``, by checksum.
+
+    Features are normalised and stored as float16 by default, so the cosine
+    similarity of two of them is their dot product. :meth:`search` finds the
+    exact nearest neighbours with blocked matrix products over the memory
+    mapped store. After :meth:`train` it can instead scan only the inverted
+    lists (IVF) of the ``n_probe`` k-means centroids closest to each query.
+
+    The centroids and the list of every row are kept in ``centroids.npy`` and
+    ``lists.bin``. :meth:`train` replaces both, and then the ``version``
+    stamp they share, under the file lock of the store. Instances notice a
+    new stamp, e.g. after another process retrained the index, and reload
+    both files. The lists are also kept in memory; the file lock is only
+    taken when rows were added since they were last assigned.
+    """
+
+    def __init__(self, path=None, dim=4096, dtype='float16'):
+        self.path = op.join(default_index_dir(), 'feature') if path is None else path
+        self.store = VectorStore(op.join(self.path, 'vectors'), dim, dtype=dtype)
+        self._centroids_path = op.join(self.path, 'centroids.npy')
+        self._lists_path = op.join(self.path, 'lists.bin')
+        self._version_path = op.join(self.path, 'version')
+        self._lock = threading.Lock()
+        # loaded by the first search with n_probe
+        self.centroids = None
+        self._lists = np.empty(0, dtype=np.int32)
+        # stamp of the loaded centroids; False before the first load
+        self._version = False
+
+    def __len__(self):
+        return len(self.store)
+
+    def __contains__(self, key):
+        return key in self.store
+
+    def add(self, keys, features):
+        self.store.add_many(keys, _normalize(features))
+
+    def get(self, key):
+        return self.store.get(key)
+
+    def _blocks(self, block_size, rows=None, stored=None):
+        stored = self.store.vectors() if stored is None else stored
+        if rows is None:
+            for start in range(0, stored.shape[0], block_size):
+                yield np.arange(start, min(start + block_size, stored.shape[0])), \
+                    np.asarray(stored[start:start + block_size], dtype=np.float32)
+        else:
+            for start in range(0, len(rows), block_size):
+                block_rows = rows[start:start + block_size]
+                yield block_rows, np.asarray(stored[block_rows], dtype=np.float32)
+
+    def _assign(self, rows, stored, centroids, block_size):
+        assignment = [np.empty(0, dtype=np.int32)]
+        for _, block in self._blocks(block_size, rows, stored):
+            assignment.append(_nearest_centroid(block, centroids))
+        return np.concatenate(assignment)
+
+    def train(self, n_lists=1024, n_iter=10, sample_size=100000, block_size=16384,
+              seed=0):
+        """Cluster the stored features with k-means for approximate search."""
+        stored = self.store.vectors()
+        if stored.shape[0] < n_lists:
+            raise ValueError('need at least {} features to train'.format(n_lists))
+        rng = np.random.RandomState(seed)
+        sample = np.sort(rng.choice(
+            stored.shape[0], min(sample_size, stored.shape[0]), replace=False))
+        sample = np.asarray(stored[sample], dtype=np.float32)
+        centroids = sample[rng.choice(sample.shape[0], n_lists, replace=False)]
+        for _ in range(n_iter):
+            assignment = _nearest_centroid(sample, centroids)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignment, sample)
+            empty = np.bincount(assignment, minlength=n_lists) == 0
+            # restart empty clusters from random samples
+            sums[empty] = sample[rng.choice(sample.shape[0], empty.sum())]
+            centroids = _normalize(sums)
+        lists = self._assign(np.arange(stored.shape[0]), stored, centroids, block_size)
+        buf = io.BytesIO()
+        np.save(buf, centroids)
+        with self._lock, file_lock(self.store.lock_path):
+            # readers reload when the stamp changes, so it is written last
+            _replace(self._centroids_path, buf.getvalue())
+            _replace(self._lists_path, lists.tobytes())
+            _replace(self._version_path, uuid.uuid4().hex.encode())
+            self._reload()
+
+    def _read_version(self):
+        try:
+            with open(self._version_path) as f:
+                return f.read()
+        except OSError:
+            # indexes trained before the stamp was added
+            return '' if op.exists(self._centroids_path) else None
+
+    def _reload(self):
+        """Load the centroids and the lists if their stamp has changed."""
+        version = self._read_version()
+        if version == self._version:
+            return
+        self.centroids = None if version is None else np.load(self._centroids_path)
+        self._lists = np.empty(0, dtype=np.int32)
+        self._version = version
+        self._read_lists()
+
+    def _read_lists(self):
+        """Append the entries other processes added to ``lists.bin``."""
+        try:
+            with open(self._lists_path, 'rb') as f:
+                f.seek(len(self._lists) * 4)
+                data = f.read()
+        except OSError:
+            return
+        data = data[:len(data) // 4 * 4]
+        self._lists = np.concatenate([self._lists, np.frombuffer(data, dtype=np.int32)])
+
+    def _update_lists(self, block_size):
+        """Return the centroids and the lists of all rows, up to date.
+
+        The files are only read, and the rows added since the last call
+        assigned, when the stamp changed or rows were added. This happens
+        under the file lock of the store, so no other process retrains the
+        index meanwhile. New assignments are appended to ``lists.bin``, or
+        only kept in memory if the index directory is read-only.
+        """
+        with self._lock:
+            if self._read_version() != self._version or (
+                    self.centroids is not None and len(self._lists) < len(self.store)):
+                # read the rows before taking the file lock, which add()
+                # takes after the lock of the store
+                stored = self.store.vectors()
+                try:
+                    with file_lock(self.store.lock_path):
+                        self._sync_lists(stored, block_size, write=True)
+                except PermissionError:
+                    self._sync_lists(stored, block_size, write=False)
+            return self.centroids, self._lists
+
+    def _sync_lists(self, stored, block_size, write):
+        self._reload()
+        self._read_lists()
+        rows = np.arange(len(self._lists), stored.shape[0])
+        if self.centroids is None or not len(rows):
+            return
+        lists = self._assign(rows, stored, self.centroids, block_size)
+        if write:
+            with open(self._lists_path, 'ab') as f:
+                # drop a partial entry left behind by a writer that died
+                f.truncate(len(self._lists) * 4)
+                f.write(lists.tobytes())
+        self._lists = np.concatenate([self._lists, lists])
+
+    def search(self, features, k=10, n_probe=None, block_size=16384):
+        """Return the ``k`` most similar stored checksums of every feature.
+
+        Each result is a list of ``(checksum, cosine similarity)`` pairs, most
+        similar first. With ``n_probe`` set on a trained index, only the
+        features in the ``n_probe`` nearest lists of each query are compared.
+        """
+        queries = _normalize(features)
+        centroids, lists = (None, None) if n_probe is None else \
+            self._update_lists(block_size)
+        if centroids is None:
+            best = self._scan(queries, None, k, block_size)
+        else:
+            probes = _sorted_top_k(queries.dot(centroids.T), n_probe)
+            best = ([], [])
+            for query, probe in zip(queries, probes):
+                rows = np.flatnonzero(np.isin(lists, probe))
+                distance, rows = self._scan(query[np.newaxis], rows, k, block_size)
+                best[0].append(distance[0])
+                best[1].append(rows[0])
+        return [
+            [(self.store.key(row), float(-dist)) for dist, row in zip(dists, rows)]
+            for dists, rows in zip(*best)]
+
+    def _scan(self, queries, rows, k, block_size):
+        best = (np.empty((len(queries), 0), dtype=np.float32),
+                np.empty((len(queries), 0), dtype=np.int64))
+        for block_rows, block in self._blocks(block_size, rows):
+            distance = -queries.dot(block.T)
+            block_rows = np.broadcast_to(block_rows, distance.shape)
+            best = _merge_top_k(best, (distance, block_rows), k)
+        return best
@@ -0,0 +1,175 @@
+"""Timing metrics of the tagging hot path.
+
+Every stage (``decode``, ``resize``, ``forward``, ``postprocess``,
+``checksum`` and ``db_write``) is timed once per call with :func:`timed`, and
+the time is recorded per call and, divided by the number of images the call
+handled, per image. Recording only takes a lock and a bisection, so it is
+always on. The server exposes the metrics in the Prometheus text format on
+``/metrics``; ``i2v --profile`` prints a summary when a command finishes.
+
+Stages run in the worker processes of a :class:`i2v.preprocess.PreprocessPool`
+are recorded in those processes and do not show up in the parent.
+"""
+from bisect import bisect_left
+from contextlib import contextmanager
+import threading
+import time
+
+
+TIME_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+    2.5, 5.0, 10.0)
+SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256)
+
+
+def _format_labels(labelnames, values, extra=()):
+    pairs = list(zip(labelnames, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(
+        '{}="{}"'.format(name, str(value).replace('\\', r'\\').replace('"', r'\"'))
+        for name, value in pairs) + '}'
+
+
+def _format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter(object):
+    """Monotonic counter with optional labels."""
+
+    kind = 'counter'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels[name] for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(tuple(labels[name] for name in self.labelnames), 0)
+
+    def expose(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        for key, value in values:
+            yield '{}{} {}'.format(
+                self.name, _format_labels(self.labelnames, key), _format_value(value))
+
+
+class Histogram(object):
+    """Histogram with fixed buckets and optional labels."""
+
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=TIME_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        # labels -> [count per bucket (the last one is +Inf), sum]
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, count=1, **labels):
+        """Record ``count`` observations of ``value``."""
+        key = tuple(labels[name] for name in self.labelnames)
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            entry[0][index] += count
+            entry[1] += value * count
+
+    def stats(self, **labels):
+        """Return the number and the sum of the observations."""
+        entry = self._values.get(tuple(labels[name] for name in self.labelnames))
+        if entry is None:
+            return 0, 0.0
+        return sum(entry[0]), entry[1]
+
+    def expose(self):
+        with self._lock:
+            values = sorted((key, (list(counts), total))
+                            for key, (counts, total) in self._values.items())
+        for key, (counts, total) in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                yield '{}_bucket{} {}'.format(
+                    self.name,
+                    _format_labels(self.labelnames, key, [('le', bound)]),
+                    cumulative)
+            labels = _format_labels(self.labelnames, key)
+            yield '{}_sum{} {}'.format(self.name, labels, repr(total))
+            yield '{}_count{} {}'.format(self.name, labels, cumulative)
+
+
+class Registry(object):
+    """Collection of metrics rendered together."""
+
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def expose(self):
+        """Return all metrics in the Prometheus text exposition format."""
+        lines = []
+        for metric in self.metrics:
+            lines.append('# HELP {} {}'.format(metric.name, metric.documentation))
+            lines.append('# TYPE {} {}'.format(metric.name, metric.kind))
+            lines.extend(metric.expose())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+STAGE_SECONDS = REGISTRY.register(Histogram(
+    'i2v_stage_seconds', 'Time spent in one call of a stage.', ('stage',)))
+STAGE_IMAGE_SECONDS = REGISTRY.register(Histogram(
+    'i2v_stage_image_seconds', 'Time spent in a stage per image.', ('stage',)))
+STAGE_IMAGES = REGISTRY.register(Counter(
+    'i2v_stage_images_total', 'Images processed by a stage.', ('stage',)))
+BATCH_SIZE = REGISTRY.register(Histogram(
+    'i2v_batch_size', 'Number of requests in a scheduler batch.',
+    buckets=SIZE_BUCKETS))
+
+
+def record(stage, seconds, n_images=1):
+    """Record that ``stage`` took ``seconds`` for ``n_images`` images."""
+    STAGE_SECONDS.observe(seconds, stage=stage)
+    if n_images:
+        STAGE_IMAGE_SECONDS.observe(seconds / n_images, count=n_images, stage=stage)
+        STAGE_IMAGES.inc(n_images, stage=stage)
+
+
+@contextmanager
+def timed(stage, n_images=1):
+    """Record the time spent in the ``with`` block as one call of ``stage``."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(stage, time.perf_counter() - start, n_images)
+
+
+def summary():
+    """Return a table of the calls, images and time of every stage."""
+    stages = sorted(key[0] for key in STAGE_SECONDS._values)
+    lines = ['{:<12} {:>8} {:>8} {:>10} {:>12}'.format(
+        'stage', 'calls', 'images', 'total s', 'ms/image')]
+    for stage in stages:
+        calls, total = STAGE_SECONDS.stats(stage=stage)
+        images = STAGE_IMAGES.value(stage=stage)
+        lines.append('{:<12} {:>8} {:>8} {:>10.3f} {:>12.3f}'.format(
+            stage, calls, images, total, 1000 * total / images if images else 0))
+    return '\n'.join(lines)
@@ -0,0 +1,40 @@
+"""Add composite indexes on tag_estimation and tag.
+
+Revision ID: 3b1f0c2a9d47
+Revises:
+Create Date: 2026-10-18 15:20:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3b1f0c2a9d47'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+INDEXES = [
+    ('ix_tag_estimation_checksum_id_tag_id_mode', 'tag_estimation',
+     ['checksum_id', 'tag_id', 'mode']),
+    ('ix_tag_value_namespace_id', 'tag', ['value', 'namespace_id']),
+]
+
+
+def _existing(table):
+    return {index['name'] for index in sa.inspect(op.get_bind()).get_indexes(table)}
+
+
+def upgrade():
+    # databases created after the indexes were added to the models already
+    # have them, since the server creates missing tables on start
+    for name, table, columns in INDEXES:
+        if name not in _existing(table):
+            op.create_index(name, table, columns)
+
+
+def downgrade():
+    for name, table, _ in INDEXES:
+        if name in _existing(table):
+            op.drop_index(name, table_name=table)
@@ -1,22 +1,45 @@
 #!/usr/bin/env python3
 """Model module."""
-from datetime import datetime
-import hashlib
+from datetime import datetime, timedelta
+import itertools
 import os
 import os.path as op
 
+import sqlite3
+import weakref
+
 from appdirs import user_data_dir
 from flask_admin import form
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import bindparam
+from sqlalchemy.engine import Engine
+from sqlalchemy.engine.url import make_url
 from sqlalchemy.event import listens_for
+from sqlalchemy.orm import Session
 from sqlalchemy.types import TIMESTAMP
 from sqlalchemy_utils.types.choice import ChoiceType
 
+from . import checksum, metrics
+
 MODE_PLAUSIBLE_TAG = 'plausible'
 MODE_TOP_TAG = 'top'
 MODE_ALL_TAG = 'all'
+JOB_PENDING = 'pending'
+JOB_RUNNING = 'running'
+JOB_DONE = 'done'
+JOB_FAILED = 'failed'
 db = SQLAlchemy()
 file_path = op.join(user_data_dir('Illustration2Vec', 'Masaki Saito'), 'files')
+DEFAULT_DATABASE_URL = 'sqlite:///i2v.sqlite'
+# applied to every SQLite connection: the write-ahead log lets readers work
+# while a writer commits, and NORMAL sync is safe with it
+SQLITE_PRAGMAS = (
+    ('journal_mode', 'WAL'),
+    ('synchronous', 'NORMAL'),
+    ('busy_timeout', 30000),
+    ('cache_size', -65536),
+    ('mmap_size', 1 << 28),
+)
 checksum_tags = db.Table('checksum_tags',
     db.Column('checksum_id', db.Integer, db.ForeignKey('checksum.id'), primary_key=True),
     db.Column('tag_id', db.Integer, db.ForeignKey('tag.id'), primary_key=True)
@@ -27,6 +50,41 @@ checksum_invalid_tags = db.Table('checksum_invalid_tags',
 )
 
 
+def database_url():
+    """Return the database URL from ``DATABASE_URL``, or the local SQLite file."""
+    url = os.getenv('DATABASE_URL') or DEFAULT_DATABASE_URL
+    if url.startswith('postgres://'):
+        # the scheme used by some hosting services, unknown to SQLAlchemy
+        url = 'postgresql://' + url[len('postgres://'):]
+    return url
+
+
+def engine_options(url, pool_size=None):
+    """Return the engine options of the database at ``url``.
+
+    Server databases get a pool of ``pool_size`` connections (default:
+    ``ILLUSTRATION2VEC_DB_POOL_SIZE`` or 10) whose connections are checked
+    before use; SQLite keeps the default pool.
+    """
+    if make_url(url).get_backend_name() == 'sqlite':
+        return {}
+    if pool_size is None:
+        pool_size = int(os.getenv('ILLUSTRATION2VEC_DB_POOL_SIZE', 10))
+    return {
+        'pool_size': pool_size, 'max_overflow': pool_size,
+        'pool_pre_ping': True, 'pool_recycle': 3600}
+
+
+@listens_for(Engine, 'connect')
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    cursor = dbapi_connection.cursor()
+    for name, value in SQLITE_PRAGMAS:
+        cursor.execute('PRAGMA {} = {}'.format(name, value))
+    cursor.close()
+
+
 class Base(db.Model):
     __abstract__ = True
     id = db.Column(db.Integer, primary_key=True)
@@ -58,12 +116,21 @@ class Image(Base):
         return form.thumbgen_filename(self.path)
 
 
-def sha256_checksum(filename, block_size=65536):
-    sha256 = hashlib.sha256()
-    with open(filename, 'rb') as f:
-        for block in iter(lambda: f.read(block_size), b''):
-            sha256.update(block)
-    return sha256.hexdigest()
+def sha256_checksum(filename, block_size=None):
+    """Return the sha256 checksum of ``filename``; see :mod:`i2v.checksum`.
+
+    ``block_size`` is accepted for compatibility and ignored; the read size
+    is chosen from the size of the file.
+    """
+    with metrics.timed('checksum'):
+        return checksum.file_sha256(filename)
+
+
+def sha256_checksums(filenames, workers=None):
+    """Return the sha256 checksums of ``filenames``, hashed in parallel."""
+    filenames = list(filenames)
+    with metrics.timed('checksum', len(filenames)):
+        return checksum.file_sha256_many(filenames, workers=workers)
 
 
 @listens_for(Image, 'after_delete')
@@ -103,21 +170,77 @@ class Checksum(Base):
                     e_item.value = estimation_value
                     yield e_item
 
+    def bulk_update_tag_estimation(self, tags, mode=MODE_PLAUSIBLE_TAG, session=None):
+        """Store the estimation result ``tags`` with a few bulk statements.
+
+        Unlike :meth:`update_tag_estimation` this does not load a model for
+        every tag: tag ids come from :func:`get_tag_ids`, and the estimations
+        are written with one executemany for updates and one for inserts.
+        The caller commits the session. Returns the number of rows written.
+        """
+        session = db.session if session is None else session
+        values = {}
+        for nm, list_value in tags.items():
+            if list_value:
+                for tag_value, estimation_value in list_value:
+                    values[(nm or None, str(tag_value))] = float(estimation_value)
+        if not values:
+            return 0
+        tag_ids = get_tag_ids(values.keys(), session=session)
+        if self.id is None:
+            session.add(self)
+            session.flush()
+        existing = dict(
+            session.query(TagEstimation.tag_id, TagEstimation.id)
+            .filter(TagEstimation.checksum_id == self.id, TagEstimation.mode == mode))
+        inserts, updates = [], []
+        for key, value in values.items():
+            tag_id = tag_ids[key]
+            if tag_id in existing:
+                updates.append({'e_id': existing[tag_id], 'e_value': value})
+            else:
+                inserts.append({
+                    'checksum_id': self.id, 'tag_id': tag_id,
+                    'mode': mode, 'value': value})
+        table = TagEstimation.__table__
+        if updates:
+            session.execute(
+                table.update().where(table.c.id == bindparam('e_id'))
+                .values(value=bindparam('e_value')),
+                updates)
+        if inserts:
+            session.execute(table.insert(), inserts)
+        return len(values)
+
     def __repr__(self):
         return '<Checksum {0.id} {0.value}>'.format(self)
 
-    def get_estimated_tags(self, mode=MODE_PLAUSIBLE_TAG):
+    def get_estimated_tags(self, mode=MODE_PLAUSIBLE_TAG, session=None):
+        """Return the estimations of ``mode`` by namespace.
+
+        Items are ``(tag value, confidence, tag id, status)`` tuples, where
+        status tells whether the tag was confirmed as valid or invalid for
+        this checksum. The estimations are read with one joined query.
+        """
+        session = db.session if session is None else session
         res = {'character': [], 'copyright': [], 'general': [], 'rating': []}
-        for estimation in self.tag_estimations:
-            if estimation.mode == mode:
-                if estimation.tag in self.tags:
-                    status = 'valid'
-                elif estimation.tag in self.invalid_tags:
-                    status = 'invalid'
-                else:
-                    status = 'unknown'
-                res.setdefault(estimation.tag.namespace.value, []).append(
-                    (estimation.tag.value, estimation.value, estimation.tag.id, status))
+        if self.id is None:
+            return res
+        valid = {tag.id for tag in self.tags}
+        invalid = {tag.id for tag in self.invalid_tags}
+        query = session.query(Tag.id, Tag.value, Namespace.value, TagEstimation.value) \
+            .join(Tag, TagEstimation.tag_id == Tag.id) \
+            .outerjoin(Namespace, Tag.namespace_id == Namespace.id) \
+            .filter(TagEstimation.checksum_id == self.id, TagEstimation.mode == mode) \
+            .order_by(TagEstimation.id)
+        for tag_id, value, namespace, confidence in query:
+            if tag_id in valid:
+                status = 'valid'
+            elif tag_id in invalid:
+                status = 'invalid'
+            else:
+                status = 'unknown'
+            res.setdefault(namespace, []).append((value, confidence, tag_id, status))
         return res
 
 
@@ -137,6 +260,9 @@ class TagEstimation(Base):
         backref=db.backref('tag_estimations', lazy=True))
     value = db.Column(db.Float)
     mode = db.Column(ChoiceType(MODES))
+    __table_args__ = (
+        db.Index('ix_tag_estimation_checksum_id_tag_id_mode', 'checksum_id', 'tag_id', 'mode'),
+    )
 
     def __repr__(self):
         templ = \
@@ -146,6 +272,77 @@ class TagEstimation(Base):
         )
 
 
+class TagJob(Base):
+    """Queued tag estimation of a checksum, processed by ``i2v worker``."""
+    STATUSES = [
+        (JOB_PENDING, JOB_PENDING),
+        (JOB_RUNNING, JOB_RUNNING),
+        (JOB_DONE, JOB_DONE),
+        (JOB_FAILED, JOB_FAILED),
+    ]
+    checksum_id = db.Column(db.Integer, db.ForeignKey('checksum.id'))
+    checksum = db.relationship(
+        'Checksum', foreign_keys='TagJob.checksum_id', lazy='subquery',
+        backref=db.backref('tag_jobs', lazy=True, cascade='delete'))
+    mode = db.Column(ChoiceType(TagEstimation.MODES))
+    status = db.Column(ChoiceType(STATUSES), default=JOB_PENDING, nullable=False, index=True)
+    worker = db.Column(db.String)
+    error = db.Column(db.String)
+    started_at = db.Column(TIMESTAMP)
+    finished_at = db.Column(TIMESTAMP)
+
+    def __repr__(self):
+        return '<TagJob {0.id} {0.mode.value} {0.status.value}>'.format(self)
+
+
+def enqueue_tag_job(checksum, mode=MODE_PLAUSIBLE_TAG, session=None):
+    """Return the unfinished job tagging ``checksum``, creating it if needed.
+
+    The caller commits the session.
+    """
+    session = db.session if session is None else session
+    job = session.query(TagJob).filter(
+        TagJob.checksum == checksum, TagJob.mode == mode,
+        TagJob.status.in_([JOB_PENDING, JOB_RUNNING])).first()
+    if job is None:
+        job = TagJob(checksum=checksum, mode=mode, status=JOB_PENDING)
+        session.add(job)
+    return job
+
+
+def claim_tag_jobs(worker, limit=16, stale_after=None, session=None):
+    """Mark up to ``limit`` pending jobs as running by ``worker`` and return them.
+
+    The jobs are claimed with one conditional update, so concurrent workers
+    never get the same job. With ``stale_after`` (seconds), jobs running for
+    longer than that, e.g. because their worker died, are claimed again.
+    """
+    session = db.session if session is None else session
+    table = TagJob.__table__
+    now = datetime.now()
+    if stale_after is not None:
+        session.execute(
+            table.update()
+            .where(table.c.status == JOB_RUNNING)
+            .where(table.c.started_at < now - timedelta(seconds=stale_after))
+            .values(status=JOB_PENDING))
+    ids = [
+        job_id for job_id, in session.query(TagJob.id)
+        .filter(TagJob.status == JOB_PENDING).order_by(TagJob.id).limit(limit)]
+    if ids:
+        session.execute(
+            table.update()
+            .where(table.c.id.in_(ids))
+            .where(table.c.status == JOB_PENDING)
+            .values(status=JOB_RUNNING, worker=worker, started_at=now, error=None))
+    session.commit()
+    if not ids:
+        return []
+    return session.query(TagJob).filter(
+        TagJob.id.in_(ids), TagJob.status == JOB_RUNNING,
+        TagJob.worker == worker, TagJob.started_at == now).order_by(TagJob.id).all()
+
+
 def get_or_create_tag(value, namespace=None, session=None):
     session = db.session if session is None else session
     kwargs = dict(value=value)
@@ -156,25 +353,114 @@ def get_or_create_tag(value, namespace=None, session=None):
     return model, created
 
 
+# engine -> {(namespace value, tag value): tag id}, shared by every session
+# of the process using that engine; cleared whenever a transaction is rolled
+# back or tags or namespaces are changed or deleted
+_tag_ids = weakref.WeakKeyDictionary()
+
+
+@listens_for(Session, 'after_rollback')
+def _clear_tag_ids(session):
+    _tag_ids.clear()
+
+
+@listens_for(Session, 'after_flush')
+def _clear_changed_tag_ids(session, flush_context):
+    changed = itertools.chain(
+        session.deleted,
+        (obj for obj in session.dirty
+         if session.is_modified(obj, include_collections=False)))
+    if any(isinstance(obj, (Tag, Namespace)) for obj in changed):
+        _tag_ids.clear()
+
+
+@listens_for(Session, 'after_bulk_update')
+@listens_for(Session, 'after_bulk_delete')
+def _clear_bulk_tag_ids(context):
+    if context.mapper.class_ in (Tag, Namespace):
+        _tag_ids.clear()
+
+
+def _load_tag_ids(session):
+    tag_ids = _tag_ids.setdefault(session.get_bind(Tag.__mapper__), {})
+    query = session.query(Tag.id, Tag.value, Namespace.value).outerjoin(
+        Namespace, Tag.namespace_id == Namespace.id)
+    for tag_id, value, namespace in query:
+        tag_ids.setdefault((namespace, value), tag_id)
+    return tag_ids
+
+
+def get_tag_ids(keys, session=None):
+    """Return a dict mapping (namespace, value) ``keys`` to tag ids.
+
+    The ids of all tags are loaded once per database and kept in memory.
+    Missing tags, and their namespaces, are created with one bulk insert.
+    """
+    session = db.session if session is None else session
+    keys = set(keys)
+    tag_ids = _tag_ids.get(session.get_bind(Tag.__mapper__))
+    if not tag_ids or not keys.issubset(tag_ids):
+        tag_ids = _load_tag_ids(session)
+    missing = keys.difference(tag_ids)
+    if missing:
+        namespace_ids = {}
+        for namespace in {nm for nm, _ in missing if nm}:
+            namespace_ids[namespace] = get_or_create(
+                session, Namespace, value=namespace)[0]
+        session.flush()
+        session.execute(Tag.__table__.insert(), [
+            {
+                'value': value,
+                'namespace_id': namespace_ids[nm].id if nm else None,
+            } for nm, value in missing])
+        tag_ids = _load_tag_ids(session)
+    return {key: tag_ids[key] for key in keys}
+
+
 class Tag(Base):
     value = db.Column(db.String)
     namespace_id = db.Column(db.Integer, db.ForeignKey('namespace.id'))
     namespace = db.relationship(
         'Namespace', foreign_keys='Tag.namespace_id', lazy='subquery',
         backref=db.backref('tags', lazy=True))
+    __table_args__ = (
+        db.Index('ix_tag_value_namespace_id', 'value', 'namespace_id'),
+    )
 
     @property
     def fullname(self):
-        res = ''
-        if self.namespace:
-            res = self.namespace.value + ':'
-        res += self.value
-        return res
+        return tag_fullname(self.value, self.namespace.value if self.namespace else None)
 
     def __repr__(self):
         return '<Tag {0.id} {0.fullname}>'.format(self)
 
 
+def tag_fullname(value, namespace=None):
+    """Return the name of a tag as shown to users, ``namespace:value``."""
+    return '{}:{}'.format(namespace, value) if namespace else value
+
+
+def query_tag_estimations(checksum_id, tag_id=None, session=None):
+    """Return the estimations of a checksum with one joined query.
+
+    Rows are ``(tag_id, fullname, mode, value)`` tuples, where ``mode`` is
+    the mode code. With ``tag_id`` only the estimations of that tag are
+    returned.
+    """
+    session = db.session if session is None else session
+    query = session.query(
+        TagEstimation.tag_id, Tag.value, Namespace.value,
+        TagEstimation.mode, TagEstimation.value) \
+        .join(Tag, TagEstimation.tag_id == Tag.id) \
+        .outerjoin(Namespace, Tag.namespace_id == Namespace.id) \
+        .filter(TagEstimation.checksum_id == checksum_id)
+    if tag_id is not None:
+        query = query.filter(TagEstimation.tag_id == tag_id)
+    return [
+        (t_id, tag_fullname(value, namespace), mode.code, confidence)
+        for t_id, value, namespace, mode, confidence in query.order_by(TagEstimation.id)]
+
+
 class Namespace(Base):
     value = db.Column(db.String, unique=True)
 
@@ -0,0 +1,175 @@
+"""Streaming tagging pipeline for large sets of image files.
+
+Images are hashed, decoded and resized by a pool of loader threads, tagged in
+batches by an inference thread (images found in the model's prediction cache
+are neither decoded nor run through the network), and handed back to the caller in input order
+while the rest of the input is still being processed. Every stage is
+connected by a bounded queue, so memory use does not depend on the number of
+input files.
+"""
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import queue
+import threading
+
+from . import metrics
+from .models import sha256_checksum
+
+
+_DONE = object()
+
+
+def _put(queue_, item, stop):
+    """Put ``item`` on ``queue_`` unless ``stop`` is set while waiting."""
+    while not stop.is_set():
+        try:
+            queue_.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+def _get(queue_, stop):
+    """Get an item from ``queue_``, or ``_DONE`` once ``stop`` is set."""
+    while not stop.is_set():
+        try:
+            return queue_.get(timeout=0.1)
+        except queue.Empty:
+            pass
+    return _DONE
+
+
+def _load(illust2vec, path):
+    item = {'image': path, 'sha256': sha256_checksum(path)}
+    cache = illust2vec.prediction_cache
+    if cache is None or item['sha256'] not in cache:
+        item['array'] = illust2vec._prepare_image(path)
+    return item
+
+
+def _produce(illust2vec, paths, loaded, workers, stop):
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for path in paths:
+            if not _put(loaded, (path, executor.submit(_load, illust2vec, path)), stop):
+                break
+    _put(loaded, _DONE, stop)
+
+
+def _estimate_batch(illust2vec, batch, **kwargs):
+    items = [item for item in batch if 'error' not in item]
+    if items:
+        prediction = illust2vec.predict(
+            [item.pop('array', None) for item in items],
+            keys=[item['sha256'] for item in items], batch_size=len(items))
+        for item, tags in zip(items, prediction.plausible_tags(**kwargs)):
+            item['tags'] = tags
+    return batch
+
+
+def _infer(illust2vec, loaded, estimated, batch_size, stop, **kwargs):
+    batch = []
+    try:
+        while True:
+            entry = _get(loaded, stop)
+            if entry is _DONE:
+                break
+            path, future = entry
+            try:
+                batch.append(future.result())
+            except Exception as err:
+                batch.append({'image': path, 'error': str(err)})
+            if len(batch) >= batch_size:
+                if not _put(estimated, _estimate_batch(illust2vec, batch, **kwargs), stop):
+                    return
+                batch = []
+        if batch:
+            _put(estimated, _estimate_batch(illust2vec, batch, **kwargs), stop)
+    except Exception as err:
+        _put(estimated, err, stop)
+    _put(estimated, _DONE, stop)
+
+
+def iter_plausible_tags(illust2vec, paths, batch_size=16, workers=4, **kwargs):
+    """Yield the plausible tags of the image files in ``paths``.
+
+    Each result is a dictionary with ``image``, ``sha256`` and ``tags`` keys,
+    or ``image`` and ``error`` keys when the file could not be read. Results
+    are yielded in input order. Other keyword arguments are passed to
+    ``estimate_plausible_tags``.
+    """
+    loaded = queue.Queue(maxsize=2 * batch_size)
+    estimated = queue.Queue(maxsize=2)
+    stop = threading.Event()
+    threads = [
+        threading.Thread(
+            target=_produce, args=(illust2vec, paths, loaded, workers, stop)),
+        threading.Thread(
+            target=_infer, args=(illust2vec, loaded, estimated, batch_size, stop),
+            kwargs=kwargs),
+    ]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    try:
+        while True:
+            batch = estimated.get()
+            if batch is _DONE:
+                break
+            if isinstance(batch, Exception):
+                raise batch
+            for item in batch:
+                yield item
+    finally:
+        stop.set()
+
+
+def _read(illust2vec, name, data, seen):
+    with metrics.timed('checksum'):
+        item = {'image': name, 'sha256': hashlib.sha256(data).hexdigest()}
+    cache = illust2vec.prediction_cache
+    if item['sha256'] not in seen and (cache is None or item['sha256'] not in cache):
+        item['array'] = illust2vec._prepare_image(data)
+        seen.add(item['sha256'])
+    return item
+
+
+def _predict_batch(illust2vec, batch):
+    arrays = {}
+    for item in batch:
+        if 'error' not in item:
+            array = item.pop('array', None)
+            if array is not None or item['sha256'] not in arrays:
+                arrays[item['sha256']] = array
+    rows = {}
+    if arrays:
+        prediction = illust2vec.predict(
+            list(arrays.values()), keys=list(arrays), batch_size=len(arrays))
+        rows = dict(zip(arrays, prediction))
+    return [(item, rows.get(item.get('sha256'))) for item in batch]
+
+
+def iter_predictions(illust2vec, images, batch_size=16):
+    """Yield an ``(item, prediction)`` pair for every image in ``images``.
+
+    ``images`` is an iterable of ``(name, data)`` pairs, ``data`` being the
+    content of an image file; it is consumed one batch at a time. ``item`` is
+    a dictionary with ``image`` and ``sha256`` keys and ``prediction`` a
+    one-image :class:`i2v.base.TagPrediction`, or ``item`` has ``image`` and
+    ``error`` keys and ``prediction`` is None when the data could not be
+    read. Images with the same content are run through the network once per
+    batch, and not at all if they are in the model's prediction cache.
+    """
+    batch, seen = [], set()
+    for name, data in images:
+        try:
+            batch.append(_read(illust2vec, name, data, seen))
+        except Exception as err:
+            batch.append({'image': name, 'error': str(err)})
+        if len(batch) >= batch_size:
+            for result in _predict_batch(illust2vec, batch):
+                yield result
+            batch, seen = [], set()
+    if batch:
+        for result in _predict_batch(illust2vec, batch):
+            yield result
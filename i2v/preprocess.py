@@ -0,0 +1,97 @@
+"""Parallel image preprocessing.
+
+A :class:`PreprocessPool` decodes and resizes images in worker processes (or
+threads) and writes the results straight into a shared float32 buffer, so
+only slot indices travel back to the parent process. Attach one to a model
+to use it for every estimation and feature extraction::
+
+    illust2vec.preprocess_pool = PreprocessPool(illust2vec, processes=4)
+"""
+import copy
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+import threading
+
+import numpy as np
+
+
+_worker = {}
+
+
+def _init_worker(preparer, buffer, shape):
+    _worker['preparer'] = preparer
+    _worker['array'] = np.frombuffer(buffer, dtype=np.float32).reshape(shape)
+
+
+def _prepare_shared(args):
+    index, image = args
+    _worker['array'][index] = _worker['preparer']._prepare_image(image)
+
+
+class PreprocessPool(object):
+    """Run ``illust2vec._prepare_image`` on many images in parallel.
+
+    Images may be PIL images, arrays, file paths or the bytes of image
+    files. Passing paths or bytes avoids decoding them in the parent. With
+    ``use_threads`` a thread pool is used instead of processes; PIL and numpy
+    release the GIL for most of the work. ``context`` is the
+    :mod:`multiprocessing` context, or the name of its start method, used
+    for the processes.
+    """
+
+    def __init__(self, illust2vec, processes=None, use_threads=False,
+                 chunk_size=32, context=None):
+        if not hasattr(illust2vec, 'input_size'):
+            raise TypeError('model does not have a fixed input size')
+        height, width = illust2vec.input_size
+        self.shape = (chunk_size, height, width, 3)
+        self.chunk_size = chunk_size
+        self._lock = threading.Lock()
+        if use_threads:
+            self._preparer = illust2vec
+            self.array = np.empty(self.shape, dtype=np.float32)
+            self.pool = ThreadPool(processes)
+            self._func = self._prepare_local
+        else:
+            # the workers only need the preprocessing settings; the net, the
+            # cache and the state derived from the net are left out, which
+            # also keeps the preparer picklable for spawned workers
+            preparer = copy.copy(illust2vec)
+            preparer.net = None
+            preparer.preprocess_pool = None
+            preparer.prediction_cache = None
+            preparer._specific_weights = {}
+            preparer._disabled = {}
+            if context is None or isinstance(context, str):
+                context = multiprocessing.get_context(context)
+            buffer = context.RawArray('f', int(np.prod(self.shape)))
+            self.array = np.frombuffer(buffer, dtype=np.float32).reshape(self.shape)
+            self.pool = context.Pool(
+                processes, initializer=_init_worker,
+                initargs=(preparer, buffer, self.shape))
+            self._func = _prepare_shared
+
+    def _prepare_local(self, args):
+        index, image = args
+        self.array[index] = self._preparer._prepare_image(image)
+
+    def map(self, images):
+        """Return the prepared ``images`` as one ``(N, H, W, 3)`` array."""
+        images = list(images)
+        result = np.empty((len(images),) + self.shape[1:], dtype=np.float32)
+        with self._lock:
+            for start in range(0, len(images), self.chunk_size):
+                chunk = images[start:start + self.chunk_size]
+                self.pool.map(self._func, enumerate(chunk))
+                result[start:start + len(chunk)] = self.array[:len(chunk)]
+        return result
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -1,8 +1,17 @@
-from flask import Flask
+import json
+import tarfile
+
+from flask import Flask, Response, request, stream_with_context
 from flask_restful import Api, Resource, abort
 from flask_restful_swagger import swagger
+import numpy as np
+from sqlalchemy.orm import joinedload, lazyload
+
+from . import models, pipeline, views, worker
 
-from . import models
+
+MODE_SPECIFIC_TAG = 'specific'
+TAR_MIMETYPES = ('application/x-tar', 'application/tar', 'application/gzip', 'application/x-gzip')
 
 
 class Checksum(Resource):
@@ -28,20 +37,17 @@ class Checksum(Resource):
           ]
         )
     def get(self, c_id):
-        session = models.db.session
-        item = session.query(models.Checksum).filter_by(id=c_id).first()
-        if not item:
-            abort(404, message="Checksum {} doesn't exist".format(c_id))
+        item = _get_checksum(c_id)
         return {
             'created_at': str(item.created_at),
             'id': item.id, 'value': item.value,
             'tag_estimations': [
                 {
-                    'mode': x.mode.value,
-                    'tag': x.tag.fullname,
-                    'confidence': x.value,
-                    'tag_id': x.tag.id,
-                } for x in item.tag_estimations
+                    'mode': mode,
+                    'tag': fullname,
+                    'confidence': value,
+                    'tag_id': tag_id,
+                } for tag_id, fullname, mode, value in models.query_tag_estimations(item.id)
             ],
         }
 
@@ -77,18 +83,10 @@ class ChecksumTag(Resource):
           ]
         )
     def get(self, c_id, t_id):
-        session = models.db.session
-        item = session.query(models.Checksum).filter_by(id=c_id).first()
-        if not item:
-            abort(404, message="Checksum {} doesn't exist".format(c_id))
-        tags = {}
-        for est_item in item.tag_estimations:
-            if est_item.tag_id == t_id:
-                tags.setdefault(est_item.tag.fullname, []).append(
-                    {'mode': est_item.mode.value, 'confidence': est_item.value}
-                )
-        tags = [v for _, v in tags.items()]
-        tag_item = session.query(models.Tag).filter_by(id=t_id).first()
+        item = _get_checksum(c_id)
+        tag_item = _get_tag(t_id)
+        tags = _tag_estimations(item.id, t_id)
+        tags = [tags] if tags else []
         return {
             'checksum_id': item.id, 'checksum_value': item.value,
             'tag_id': tag_item.id, 'tag_value': tag_item.fullname,
@@ -125,22 +123,12 @@ class ChecksumTag(Resource):
         )
     def post(self, c_id, t_id):
         session = models.db.session
-        item = session.query(models.Checksum).filter_by(id=c_id).first()
-        if not item:
-            abort(404, message="Checksum {} doesn't exist".format(c_id))
-        tag_item = session.query(models.Tag).filter_by(id=t_id).first()
-        if not tag_item:
-            abort(404, message="Tag {} doesn't exist".format(c_id))
+        item = _get_checksum(c_id)
+        tag_item = _get_tag(t_id)
         item.tags.append(tag_item)
         session.add(item)
         session.commit()
-        tag_estimations = {}
-        for est_item in item.tag_estimations:
-            if est_item.tag_id == t_id:
-                tag_estimations.setdefault(est_item.tag.fullname, []).append(
-                    {'mode': est_item.mode.value, 'confidence': est_item.value}
-                )
-        tag_estimations = [v for _, v in tag_estimations.items()][0]
+        tag_estimations = _tag_estimations(item.id, t_id)
         return {
             'checksum_id': item.id, 'checksum_value': item.value,
             'tag_id': tag_item.id, 'tag_value': tag_item.fullname,
@@ -178,12 +166,8 @@ class ChecksumTag(Resource):
         )
     def delete(self, c_id, t_id):
         session = models.db.session
-        item = session.query(models.Checksum).filter_by(id=c_id).first()
-        if not item:
-            abort(404, message="Checksum {} doesn't exist".format(c_id))
-        tag_item = session.query(models.Tag).filter_by(id=t_id).first()
-        if not tag_item:
-            abort(404, message="Tag {} doesn't exist".format(c_id))
+        item = _get_checksum(c_id)
+        tag_item = _get_tag(t_id)
         if tag_item in item.tags:
             item.tags.remove(tag_item)
         session.add(item)
@@ -223,22 +207,12 @@ class ChecksumInvalidTag(Resource):
         )
     def post(self, c_id, t_id):
         session = models.db.session
-        item = session.query(models.Checksum).filter_by(id=c_id).first()
-        if not item:
-            abort(404, message="Checksum {} doesn't exist".format(c_id))
-        tag_item = session.query(models.Tag).filter_by(id=t_id).first()
-        if not tag_item:
-            abort(404, message="Tag {} doesn't exist".format(c_id))
+        item = _get_checksum(c_id)
+        tag_item = _get_tag(t_id)
         item.invalid_tags.append(tag_item)
         session.add(item)
         session.commit()
-        tag_estimations = {}
-        for est_item in item.tag_estimations:
-            if est_item.tag_id == t_id:
-                tag_estimations.setdefault(est_item.tag.fullname, []).append(
-                    {'mode': est_item.mode.value, 'confidence': est_item.value}
-                )
-        tag_estimations = [v for _, v in tag_estimations.items()][0]
+        tag_estimations = _tag_estimations(item.id, t_id)
         return {
             'checksum_id': item.id, 'checksum_value': item.value,
             'tag_id': tag_item.id, 'tag_value': tag_item.fullname,
@@ -276,12 +250,8 @@ class ChecksumInvalidTag(Resource):
         )
     def delete(self, c_id, t_id):
         session = models.db.session
-        item = session.query(models.Checksum).filter_by(id=c_id).first()
-        if not item:
-            abort(404, message="Checksum {} doesn't exist".format(c_id))
-        tag_item = session.query(models.Tag).filter_by(id=t_id).first()
-        if not tag_item:
-            abort(404, message="Tag {} doesn't exist".format(c_id))
+        item = _get_checksum(c_id)
+        tag_item = _get_tag(t_id)
         if tag_item in item.invalid_tags:
             item.invalid_tags.remove(tag_item)
         session.add(item)
@@ -312,17 +282,12 @@ class ChecksumTagList(Resource):
           ]
         )
     def get(self, c_id):
-        session = models.db.session
-        item = session.query(models.Checksum).filter_by(id=c_id).first()
-        if not item:
-            abort(404, message="Checksum {} doesn't exist".format(c_id))
+        item = _get_checksum(c_id)
         tags = {}
         tag_id_name = {}
-        for est_item in item.tag_estimations:
-            tag_id_name[est_item.tag.fullname] = est_item.tag.id
-            tags.setdefault(est_item.tag.fullname, []).append(
-                {'mode': est_item.mode.value, 'confidence': est_item.value}
-            )
+        for tag_id, fullname, mode, value in models.query_tag_estimations(item.id):
+            tag_id_name[fullname] = tag_id
+            tags.setdefault(fullname, []).append({'mode': mode, 'confidence': value})
         tags = [
             {'tag_value': k, 'tag_id': tag_id_name[k], 'estimations': v}
             for k, v in tags.items()
@@ -331,3 +296,375 @@ class ChecksumTagList(Resource):
             'checksum_id': item.id, 'checksum_value': item.value,
             'tags': tags,
         }
+
+
+class ChecksumSimilar(Resource):
+    "Checksums with similar binary features."
+    @swagger.operation(
+        notes='Checksum api',
+        responseClass='checksum',
+        nickname='checksum',
+        parameters=[
+            {
+              "name": "c_id",
+              "description": "Checksum id",
+              "required": False,
+              "allowMultiple": False,
+              "dataType": 'int',
+              "paramType": "path"
+            },
+            {
+              "name": "k",
+              "description": "Number of similar checksums",
+              "required": False,
+              "allowMultiple": False,
+              "dataType": 'int',
+              "paramType": "query"
+            },
+          ],
+        responseMessages=[
+            { "code": 201, "message": "Success" },
+            { "code": 405, "message": "Invalid input" },
+            { "code": 404, "message": "Item doesn't exist" },
+          ]
+        )
+    def get(self, c_id):
+        k = request.args.get('k', 10, type=int)
+        return _similar_checksums(
+            c_id, views.get_binary_index(),
+            lambda images: views.get_feature_model().extract_binary_feature(images),
+            k=k)
+
+
+class ChecksumSimilarFeature(Resource):
+    "Checksums with similar float features."
+    @swagger.operation(
+        notes='Checksum api',
+        responseClass='checksum',
+        nickname='checksum',
+        parameters=[
+            {
+              "name": "c_id",
+              "description": "Checksum id",
+              "required": False,
+              "allowMultiple": False,
+              "dataType": 'int',
+              "paramType": "path"
+            },
+            {
+              "name": "k",
+              "description": "Number of similar checksums",
+              "required": False,
+              "allowMultiple": False,
+              "dataType": 'int',
+              "paramType": "query"
+            },
+            {
+              "name": "n_probe",
+              "description": "Number of inverted lists searched; exact search if not given",
+              "required": False,
+              "allowMultiple": False,
+              "dataType": 'int',
+              "paramType": "query"
+            },
+          ],
+        responseMessages=[
+            { "code": 201, "message": "Success" },
+            { "code": 405, "message": "Invalid input" },
+            { "code": 404, "message": "Item doesn't exist" },
+          ]
+        )
+    def get(self, c_id):
+        k = request.args.get('k', 10, type=int)
+        n_probe = request.args.get('n_probe', None, type=int)
+        return _similar_checksums(
+            c_id, views.get_feature_index(),
+            lambda images: views.get_feature_model().extract_feature(images),
+            k=k, score='similarity', n_probe=n_probe)
+
+
+class TagJob(Resource):
+    "Tag estimation job."
+    @swagger.operation(
+        notes='Tag job api',
+        responseClass='tag_job',
+        nickname='tag_job',
+        parameters=[
+            {
+              "name": "j_id",
+              "description": "Tag job id",
+              "required": False,
+              "allowMultiple": False,
+              "dataType": 'int',
+              "paramType": "path"
+            },
+          ],
+        responseMessages=[
+            { "code": 201, "message": "Success" },
+            { "code": 405, "message": "Invalid input" },
+            { "code": 404, "message": "Tag job doesn't exist" },
+          ]
+        )
+    def get(self, j_id):
+        session = models.db.session
+        item = session.query(models.TagJob).filter_by(id=j_id).first()
+        if not item:
+            abort(404, message="Tag job {} doesn't exist".format(j_id))
+        return _tag_job(item)
+
+
+class ChecksumTagJob(Resource):
+    "Tag estimation jobs of a checksum."
+    @swagger.operation(
+        notes='Checksum api',
+        responseClass='checksum',
+        nickname='checksum',
+        parameters=[
+            {
+              "name": "c_id",
+              "description": "Checksum id",
+              "required": False,
+              "allowMultiple": False,
+              "dataType": 'int',
+              "paramType": "path"
+            },
+          ],
+        responseMessages=[
+            { "code": 201, "message": "Success" },
+            { "code": 405, "message": "Invalid input" },
+            { "code": 404, "message": "Item doesn't exist" },
+          ]
+        )
+    def get(self, c_id):
+        session = models.db.session
+        item = session.query(models.Checksum).filter_by(id=c_id).first()
+        if not item:
+            abort(404, message="Checksum {} doesn't exist".format(c_id))
+        jobs = session.query(models.TagJob).filter_by(checksum_id=c_id) \
+            .order_by(models.TagJob.id)
+        return {
+            'checksum_id': item.id, 'checksum_value': item.value,
+            'jobs': [_tag_job(job) for job in jobs],
+        }
+
+    @swagger.operation(
+        notes='Checksum api',
+        responseClass='checksum',
+        nickname='checksum',
+        parameters=[
+            {
+              "name": "c_id",
+              "description": "Checksum id",
+              "required": False,
+              "allowMultiple": False,
+              "dataType": 'int',
+              "paramType": "path"
+            },
+            {
+              "name": "mode",
+              "description": "Estimation mode; plausible, top or all",
+              "required": False,
+              "allowMultiple": False,
+              "dataType": 'string',
+              "paramType": "query"
+            },
+          ],
+        responseMessages=[
+            { "code": 201, "message": "Success" },
+            { "code": 405, "message": "Invalid input" },
+            { "code": 404, "message": "Item doesn't exist" },
+          ]
+        )
+    def post(self, c_id):
+        mode = request.args.get('mode', models.MODE_PLAUSIBLE_TAG)
+        if mode not in dict(models.TagEstimation.MODES):
+            abort(405, message="Unknown mode {}".format(mode))
+        session = models.db.session
+        item = session.query(models.Checksum).filter_by(id=c_id).first()
+        if not item:
+            abort(404, message="Checksum {} doesn't exist".format(c_id))
+        job = models.enqueue_tag_job(item, mode=mode, session=session)
+        session.commit()
+        return _tag_job(job)
+
+
+class Estimate(Resource):
+    "Tag estimation of uploaded images."
+    @swagger.operation(
+        notes='Estimate the tags of many images in one call. Send the images '
+        'as multipart files, or as a tar archive with a tar content type. '
+        'Results are streamed in the order of the images.',
+        responseClass='estimation',
+        nickname='estimate',
+        parameters=[
+            {
+              "name": "mode",
+              "description": "Estimation mode; plausible, top, all or specific",
+              "required": False,
+              "allowMultiple": False,
+              "dataType": 'string',
+              "paramType": "query"
+            },
+            {
+              "name": "tag",
+              "description": "Tag to estimate in specific mode",
+              "required": False,
+              "allowMultiple": True,
+              "dataType": 'string',
+              "paramType": "query"
+            },
+            {
+              "name": "threshold",
+              "description": "Threshold of plausible tags",
+              "required": False,
+              "allowMultiple": False,
+              "dataType": 'float',
+              "paramType": "query"
+            },
+            {
+              "name": "n_tag",
+              "description": "Number of top tags",
+              "required": False,
+              "allowMultiple": False,
+              "dataType": 'int',
+              "paramType": "query"
+            },
+            {
+              "name": "batch_size",
+              "description": "Number of images per forward pass",
+              "required": False,
+              "allowMultiple": False,
+              "dataType": 'int',
+              "paramType": "query"
+            },
+          ],
+        responseMessages=[
+            { "code": 201, "message": "Success" },
+            { "code": 405, "message": "Invalid input" },
+          ]
+        )
+    def post(self):
+        mode = request.args.get('mode', models.MODE_PLAUSIBLE_TAG)
+        batch_size = request.args.get('batch_size', 32, type=int)
+        threshold = request.args.get('threshold', 0.25, type=float)
+        n_tag = request.args.get('n_tag', 10, type=int)
+        if batch_size < 1:
+            abort(405, message="batch_size must be positive")
+        illust2vec = views.get_illust2vec()
+        if mode == MODE_SPECIFIC_TAG:
+            tags = request.args.getlist('tag')
+            unknown = [tag for tag in tags if tag not in illust2vec.index]
+            if not tags or unknown:
+                abort(405, message="Unknown tags {}".format(unknown))
+            estimate = lambda prediction: prediction.specific_tags(tags)[0]
+        elif mode in dict(models.TagEstimation.MODES):
+            kwargs = {
+                models.MODE_PLAUSIBLE_TAG: {'threshold': threshold},
+                models.MODE_TOP_TAG: {'n_tag': n_tag},
+                models.MODE_ALL_TAG: {'threshold': threshold, 'n_tag': n_tag},
+            }[mode]
+            estimate = lambda prediction: worker.prediction_tags(prediction, mode, **kwargs)[0]
+        else:
+            abort(405, message="Unknown mode {}".format(mode))
+        if request.mimetype in TAR_MIMETYPES:
+            images = _iter_tar(request.stream)
+        else:
+            images = (
+                (file_.filename, file_.read())
+                for _, file_ in request.files.items(multi=True))
+
+        def generate():
+            yield '{{"mode": {}, "results": ['.format(json.dumps(mode))
+            results = pipeline.iter_predictions(illust2vec, images, batch_size=batch_size)
+            for i, (item, prediction) in enumerate(results):
+                if prediction is not None:
+                    item['tags'] = estimate(prediction)
+                yield (',' if i else '') + json.dumps(item)
+            yield ']}\n'
+
+        return Response(stream_with_context(generate()), mimetype='application/json')
+
+
+def _get_checksum(c_id):
+    """Return checksum ``c_id`` without its tags, or abort with 404."""
+    item = models.db.session.query(models.Checksum) \
+        .options(lazyload(models.Checksum.tags), lazyload(models.Checksum.invalid_tags)) \
+        .filter_by(id=c_id).first()
+    if not item:
+        abort(404, message="Checksum {} doesn't exist".format(c_id))
+    return item
+
+
+def _get_tag(t_id):
+    """Return tag ``t_id`` with its namespace, or abort with 404."""
+    tag_item = models.db.session.query(models.Tag) \
+        .options(joinedload(models.Tag.namespace)).filter_by(id=t_id).first()
+    if not tag_item:
+        abort(404, message="Tag {} doesn't exist".format(t_id))
+    return tag_item
+
+
+def _tag_estimations(c_id, t_id):
+    return [
+        {'mode': mode, 'confidence': value}
+        for _, _, mode, value in models.query_tag_estimations(c_id, tag_id=t_id)]
+
+
+def _iter_tar(stream):
+    """Yield the name and content of the files of a tar ``stream``."""
+    with tarfile.open(fileobj=stream, mode='r|*') as archive:
+        for member in archive:
+            if member.isfile():
+                yield member.name, archive.extractfile(member).read()
+
+
+def _tag_job(job):
+    return {
+        'id': job.id,
+        'checksum_id': job.checksum_id,
+        'mode': job.mode.value,
+        'status': job.status.value,
+        'worker': job.worker,
+        'error': job.error,
+        'created_at': str(job.created_at),
+        'started_at': str(job.started_at) if job.started_at else None,
+        'finished_at': str(job.finished_at) if job.finished_at else None,
+    }
+
+
+def _similar_checksums(c_id, index, extract, k, score='distance', **kwargs):
+    """Search ``index`` for the neighbours of checksum ``c_id``.
+
+    The checksum is added to the index with ``extract`` if it is missing.
+    ``score`` names the value returned by the index in the response.
+    """
+    session = models.db.session
+    item = session.query(models.Checksum).filter_by(id=c_id).first()
+    if not item:
+        abort(404, message="Checksum {} doesn't exist".format(c_id))
+    vector = index.get(item.value)
+    if vector is None:
+        if not item.images:
+            abort(404, message="Checksum {} doesn't have an image".format(c_id))
+        vector = extract([item.images[0].full_path])
+        index.add([item.value], vector)
+    else:
+        vector = vector[np.newaxis]
+    # the checksum itself is its own nearest neighbour
+    similar = [
+        (value, value_score)
+        for value, value_score in index.search(vector, k=k + 1, **kwargs)[0]
+        if value != item.value][:k]
+    ids = dict(
+        session.query(models.Checksum.value, models.Checksum.id)
+        .filter(models.Checksum.value.in_([value for value, _ in similar])))
+    return {
+        'checksum_id': item.id, 'checksum_value': item.value,
+        'similar': [
+            {
+                'checksum_id': ids.get(value),
+                'checksum_value': value,
+                score: value_score,
+            } for value, value_score in similar
+        ],
+    }
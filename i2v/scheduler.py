@@ -0,0 +1,99 @@
+"""Micro-batching scheduler for concurrent inference requests."""
+from concurrent.futures import Future
+import queue
+import threading
+import time
+
+import structlog
+
+from . import metrics
+
+
+logger = structlog.getLogger(__name__)
+_STOP = object()
+
+
+class BatchScheduler(object):
+    """Gather items submitted from many threads and process them in batches.
+
+    ``func`` receives a list of items and must return a sequence of results
+    with the same length and order. A batch is dispatched as soon as it holds
+    ``max_batch_size`` items or ``max_wait`` seconds have passed since its
+    first item arrived. If ``func`` fails on a batch, its items are processed
+    again one at a time, so only the futures of the failing items get the
+    exception.
+    """
+
+    def __init__(self, func, max_batch_size=8, max_wait=0.01):
+        if max_batch_size < 1:
+            raise ValueError('max_batch_size must be positive')
+        self.func = func
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(self, item):
+        """Queue ``item`` and return a future for its result."""
+        future = Future()
+        self._queue.put((item, future))
+        return future
+
+    def __call__(self, item, timeout=None):
+        return self.submit(item).result(timeout=timeout)
+
+    def close(self):
+        """Process the pending items and stop the worker thread."""
+        self._queue.put(_STOP)
+        self._thread.join()
+
+    def _collect(self, first):
+        batch = [first]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                entry = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if entry is _STOP:
+                # put it back so the worker loop stops after this batch
+                self._queue.put(_STOP)
+                break
+            batch.append(entry)
+        return batch
+
+    def _run(self):
+        while True:
+            entry = self._queue.get()
+            if entry is _STOP:
+                break
+            self._process(self._collect(entry))
+
+    def _call(self, batch):
+        results = self.func([item for item, _ in batch])
+        if len(results) != len(batch):
+            raise RuntimeError('batch function returned {} results for {} items'.format(
+                len(results), len(batch)))
+        return results
+
+    def _process(self, batch):
+        metrics.BATCH_SIZE.observe(len(batch))
+        try:
+            results = self._call(batch)
+        except Exception as err:
+            if len(batch) == 1:
+                logger.exception('Item failed.')
+                batch[0][1].set_exception(err)
+                return
+            logger.warning('Batch failed, retrying its items one at a time.',
+                           size=len(batch), error=str(err))
+            for entry in batch:
+                self._process([entry])
+            return
+        logger.debug('Batch processed.', size=len(batch))
+        for (_, future), result in zip(batch, results):
+            future.set_result(result)
@@ -0,0 +1,217 @@
+"""Append-only vector stores keyed by sha256 checksums."""
+from contextlib import contextmanager
+import json
+import os
+import os.path as op
+import threading
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from i2v.base import default_cache_dir
+from i2v.checksum import file_sha256
+
+
+KEY_SIZE = 32
+
+
+def default_prediction_cache_dir(param_path=None, precision='float32'):
+    """Return the prediction cache directory of a model.
+
+    Like snapshots, the results of the caffemodel at ``param_path`` are
+    keyed by its sha256 and by the ``precision`` of its weights, so other
+    models or precisions never read them. Without ``param_path`` the root
+    of all the caches is returned.
+    """
+    root = os.getenv('ILLUSTRATION2VEC_PREDICTION_CACHE') or \
+        op.join(default_cache_dir(), 'predictions')
+    if param_path is None:
+        return root
+    name = file_sha256(param_path)
+    if precision != 'float32':
+        name = '{}-{}'.format(name, precision)
+    return op.join(root, name)
+
+
+@contextmanager
+def file_lock(path):
+    """Hold an exclusive lock on the file at ``path``, shared by all processes.
+
+    Without ``fcntl`` (e.g. on Windows) nothing is locked.
+    """
+    with open(path, 'w') as lock_file:
+        if fcntl is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        yield
+
+
+class VectorStore(object):
+    """Fixed-size vectors stored by the sha256 checksum of their image.
+
+    The store is a directory holding the raw 32-byte digests in ``keys.bin``
+    and the vectors, row by row in the same order, in ``vectors.bin``, which
+    is read through a memory map. Rows are only ever appended, so several
+    processes can share a store; appends are serialised with a file lock
+    where the platform supports it.
+    """
+
+    def __init__(self, path, dim, dtype='float32'):
+        self.path = path
+        self.dim = dim
+        self.dtype = np.dtype(dtype)
+        os.makedirs(path, exist_ok=True)
+        meta_path = op.join(path, 'meta.json')
+        meta = {'dim': dim, 'dtype': self.dtype.name}
+        if op.exists(meta_path):
+            with open(meta_path) as f:
+                stored_meta = json.load(f)
+            if stored_meta != meta:
+                raise ValueError('store at {} holds {}, not {}'.format(
+                    path, stored_meta, meta))
+        else:
+            with open(meta_path, 'w') as f:
+                json.dump(meta, f)
+        # file locked by every process appending to the store
+        self.lock_path = op.join(path, 'lock')
+        self._keys_path = op.join(path, 'keys.bin')
+        self._vectors_path = op.join(path, 'vectors.bin')
+        self._lock = threading.Lock()
+        self._index = {}
+        self._keys = []
+        self._map = None
+        with self._lock:
+            self._refresh()
+
+    @property
+    def _row_size(self):
+        return self.dim * self.dtype.itemsize
+
+    def _refresh(self):
+        """Read the keys appended since the last call, by any process."""
+        try:
+            size = os.path.getsize(self._keys_path)
+        except OSError:
+            return
+        offset = len(self._keys) * KEY_SIZE
+        if size - offset < KEY_SIZE:
+            return
+        with open(self._keys_path, 'rb') as f:
+            f.seek(offset)
+            data = f.read((size - offset) // KEY_SIZE * KEY_SIZE)
+        for start in range(0, len(data), KEY_SIZE):
+            key = data[start:start + KEY_SIZE]
+            self._index.setdefault(key, len(self._keys))
+            self._keys.append(key)
+
+    def _vectors(self):
+        n_rows = len(self._keys)
+        if self._map is None or self._map.shape[0] < n_rows:
+            self._map = np.memmap(
+                self._vectors_path, dtype=self.dtype, mode='r',
+                shape=(n_rows, self.dim))
+        return self._map[:n_rows]
+
+    def _find(self, key):
+        key = bytes.fromhex(key)
+        if key not in self._index:
+            self._refresh()
+        return self._index.get(key)
+
+    def __len__(self):
+        with self._lock:
+            self._refresh()
+            return len(self._keys)
+
+    def __contains__(self, key):
+        with self._lock:
+            return self._find(key) is not None
+
+    def keys(self):
+        """Return the hex checksums of all rows in storage order."""
+        with self._lock:
+            self._refresh()
+            return [key.hex() for key in self._keys]
+
+    def key(self, row):
+        """Return the hex checksum of ``row``."""
+        with self._lock:
+            return self._keys[row].hex()
+
+    def vectors(self):
+        """Return a read-only memory map of all rows in storage order."""
+        with self._lock:
+            self._refresh()
+            if not self._keys:
+                return np.empty((0, self.dim), dtype=self.dtype)
+            return self._vectors()
+
+    def get(self, key):
+        """Return a copy of the vector stored for ``key``, or None."""
+        vectors, found = self.get_many([key])
+        return vectors[0] if found[0] else None
+
+    def get_many(self, keys):
+        """Return the vectors of ``keys`` and a mask of the keys found.
+
+        Rows of keys that are not stored are left as zeros.
+        """
+        result = np.zeros((len(keys), self.dim), dtype=self.dtype)
+        found = np.zeros(len(keys), dtype=bool)
+        with self._lock:
+            rows = [self._find(key) for key in keys]
+            if any(row is not None for row in rows):
+                vectors = self._vectors()
+                for i, row in enumerate(rows):
+                    if row is not None:
+                        result[i] = vectors[row]
+                        found[i] = True
+        return result, found
+
+    def add(self, key, vector):
+        self.add_many([key], np.asarray(vector).reshape(1, -1))
+
+    def add_many(self, keys, vectors):
+        """Append the ``vectors`` of the ``keys`` that are not stored yet."""
+        vectors = np.asarray(vectors, dtype=self.dtype).reshape(len(keys), self.dim)
+        with self._lock, file_lock(self.lock_path):
+            self._refresh()
+            new_keys, rows, seen = [], [], set()
+            for i, key in enumerate(keys):
+                key = bytes.fromhex(key)
+                if key not in self._index and key not in seen:
+                    seen.add(key)
+                    new_keys.append(key)
+                    rows.append(i)
+            if not new_keys:
+                return
+            with open(self._vectors_path, 'ab') as f:
+                # drop rows left behind by a writer that died before
+                # appending their keys
+                f.truncate(len(self._keys) * self._row_size)
+                f.write(np.ascontiguousarray(vectors[rows]).tobytes())
+            with open(self._keys_path, 'ab') as f:
+                f.write(b''.join(new_keys))
+            self._refresh()
+
+
+class PredictionCache(object):
+    """Tag probabilities, and optionally features, of already seen images.
+
+    A cache holds the results of one model; use a separate directory for
+    every model.
+    """
+
+    def __init__(self, path=None, n_tags=1539, feature_dim=None):
+        self.path = default_prediction_cache_dir() if path is None else path
+        self.prob = VectorStore(op.join(self.path, 'prob'), n_tags)
+        if feature_dim is not None:
+            self.feature = VectorStore(op.join(self.path, 'feature'), feature_dim)
+        else:
+            self.feature = None
+
+    def __contains__(self, key):
+        return key in self.prob
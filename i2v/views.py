@@ -1,6 +1,7 @@
 import hashlib
 import os
 import shutil
+import threading
 import time
 
 from flask import flash, redirect, request, url_for
@@ -10,17 +11,124 @@ from flask_admin.contrib.sqla import ModelView, filters
 from flask_admin.helpers import get_redirect_target
 from flask_admin.model.helpers import get_mdict_item_or_list
 from jinja2 import Markup
-from PIL import Image
 from werkzeug import secure_filename
 import arrow
 import structlog
 
+from . import metrics
 from . import models
+from . import worker
 from . import make_i2v_with_chainer
+from .index import BinaryFeatureIndex, FeatureIndex
+from .scheduler import BatchScheduler
+from .store import PredictionCache, default_prediction_cache_dir
 
 
 logger = structlog.getLogger(__name__)
 ILLUST2VEC = None
+FEATURE_MODEL = None
+BINARY_INDEX = None
+FEATURE_INDEX = None
+SCHEDULER = None
+_INIT_LOCK = threading.Lock()
+
+
+def model_precision():
+    """Return the precision of the weights set in ``ILLUSTRATION2VEC_PRECISION``."""
+    return os.getenv('ILLUSTRATION2VEC_PRECISION') or 'float32'
+
+
+def get_illust2vec(mmap_mode=None):
+    """Return the global tagging model, loading it on first use.
+
+    ``mmap_mode`` is used to load the weights if the model is not loaded yet,
+    and ``ILLUSTRATION2VEC_PRECISION`` selects the precision of the weights.
+    """
+    global ILLUST2VEC
+    with _INIT_LOCK:
+        if not ILLUST2VEC:
+            model_path = os.getenv('ILLUSTRATION2VEC_MODEL')
+            if not model_path:
+                model_path =  "illust2vec_tag_ver200.caffemodel"
+            precision = model_precision()
+            ILLUST2VEC = make_i2v_with_chainer(
+                model_path, "tag_list.json", mmap_mode=mmap_mode, precision=precision)
+            ILLUST2VEC.prediction_cache = PredictionCache(
+                default_prediction_cache_dir(model_path, precision))
+    return ILLUST2VEC
+
+
+def get_feature_model(mmap_mode=None):
+    """Return the global feature extraction model, loading it on first use.
+
+    ``mmap_mode`` is used to load the weights if the model is not loaded yet.
+    """
+    global FEATURE_MODEL
+    with _INIT_LOCK:
+        if not FEATURE_MODEL:
+            model_path = os.getenv('ILLUSTRATION2VEC_FEATURE_MODEL')
+            if not model_path:
+                model_path = "illust2vec_ver200.caffemodel"
+            FEATURE_MODEL = make_i2v_with_chainer(
+                model_path, mmap_mode=mmap_mode, precision=model_precision())
+    return FEATURE_MODEL
+
+
+def preload(feature_model=False):
+    """Load the models with memory mapped weights and run them once.
+
+    Call this before a server forks its workers: they then share one
+    read-only copy of the weights, and no request pays for loading the
+    model. Threads such as the scheduler are still started lazily, in the
+    workers.
+    """
+    loaded = [(get_illust2vec(mmap_mode='r'), 'prob')]
+    if feature_model:
+        loaded.append((get_feature_model(mmap_mode='r'), 'encode1'))
+    for illust2vec, layername in loaded:
+        start_time = time.time()
+        illust2vec.warm_up(layername)
+        logger.debug('Model warmed up.', layer=layername, time=(time.time() - start_time))
+
+
+def get_binary_index():
+    """Return the global binary feature index."""
+    global BINARY_INDEX
+    with _INIT_LOCK:
+        if BINARY_INDEX is None:
+            BINARY_INDEX = BinaryFeatureIndex()
+    return BINARY_INDEX
+
+
+def get_feature_index():
+    """Return the global float feature index."""
+    global FEATURE_INDEX
+    with _INIT_LOCK:
+        if FEATURE_INDEX is None:
+            FEATURE_INDEX = FeatureIndex()
+    return FEATURE_INDEX
+
+
+def get_scheduler():
+    """Return the scheduler batching tag prediction requests.
+
+    Items are ``(image, checksum)`` pairs, the image being prepared by the
+    caller with ``_prepare_image`` (or None if its prediction is cached), so
+    only the forward pass runs in the scheduler thread. Batch size and wait
+    time are read from ``ILLUSTRATION2VEC_MAX_BATCH_SIZE`` and
+    ``ILLUSTRATION2VEC_MAX_WAIT`` (seconds).
+    """
+    global SCHEDULER
+    illust2vec = get_illust2vec()
+    with _INIT_LOCK:
+        if SCHEDULER is None:
+            SCHEDULER = BatchScheduler(
+                lambda items: illust2vec.predict(
+                    [img for img, _ in items], keys=[key for _, key in items],
+                    batch_size=len(items)),
+                max_batch_size=int(os.getenv('ILLUSTRATION2VEC_MAX_BATCH_SIZE', 8)),
+                max_wait=float(os.getenv('ILLUSTRATION2VEC_MAX_WAIT', 0.01)))
+    return SCHEDULER
 
 
 class ImageUploadField(form.ImageUploadField):
@@ -127,45 +235,32 @@ class ImageView(ModelView):
             flash(gettext('Unknown mode.'), 'error')
             return redirect(return_url)
         estimated_tags = model.checksum.get_estimated_tags(mode=mode)
-        if  not any(estimated_tags.values()):
-            img = Image.open(model.full_path)
-            start_time = time.time()
-            global ILLUST2VEC
-            if not ILLUST2VEC:
-                model_path = os.getenv('ILLUSTRATION2VEC_MODEL')
-                if not model_path:
-                    model_path =  "illust2vec_tag_ver200.caffemodel"
-                ILLUST2VEC = make_i2v_with_chainer(model_path, "tag_list.json")
-            illust2vec = ILLUST2VEC
-            end = time.time()
-            logger.debug('i2v initiated', time=(time.time() - start_time))
-            if mode == models.MODE_PLAUSIBLE_TAG:
-                res = illust2vec.estimate_plausible_tags([img])
-            elif mode == models.MODE_TOP_TAG:
-                res = illust2vec.estimate_top_tags([img])
-            elif mode == models.MODE_ALL_TAG:
-                res1 = illust2vec.estimate_plausible_tags([img])
-                res2 = illust2vec.estimate_top_tags([img])
-                res = {k: dict(v) for k, v in res1[0].items()}
-                for main_key, item in res2[0].items():
-                    dict_item = dict(item)
-                    for key, value in dict_item.items():
-                        if key in res[main_key]:
-                            res[main_key][key] = (value + res[main_key][key])/2
-                        else:
-                            res[main_key][key] = value
-                for main_key, item in res.items():
-                    res[main_key] = [(k, v) for k, v in item.items()]
-                res = [res]
-            else:
-                flash(gettext('Unknown mode.'), 'error')
-                return redirect(return_url)
-            res = res[0]
+        if not any(estimated_tags.values()) and worker.queue_enabled():
+            # leave the estimation to the workers of the job queue
             session = models.db.session
-            tags = list(model.checksum.update_tag_estimation(
-                res, mode=mode, session=session))
-            list(map(session.add, tags))
+            job = models.enqueue_tag_job(model.checksum, mode=mode, session=session)
             session.commit()
+            flash(gettext(
+                'Tagging job %(id)s is %(status)s, reload the page later.',
+                id=job.id, status=job.status.code), 'info')
+        elif not any(estimated_tags.values()):
+            illust2vec = get_illust2vec()
+            scheduler = get_scheduler()
+            start_time = time.time()
+            key = model.checksum.value
+            # decode and resize in this thread, and only if the prediction is
+            # not cached; an unreadable image then fails this request alone
+            cache = illust2vec.prediction_cache
+            image = None
+            if cache is None or key not in cache:
+                image = illust2vec._prepare_image(model.full_path)
+            prediction = scheduler((image, key))
+            logger.debug('Tags predicted.', time=(time.time() - start_time))
+            res = worker.prediction_tags(prediction, mode)[0]
+            session = models.db.session
+            with metrics.timed('db_write'):
+                model.checksum.bulk_update_tag_estimation(res, mode=mode, session=session)
+                session.commit()
         estimated_tags = model.checksum.get_estimated_tags(mode=mode)
         return self.render('i2v/image_tag.html', estimated_tags=estimated_tags, model=model, mode=mode)
 
@@ -191,6 +286,8 @@ class ImageView(ModelView):
                 except FileNotFoundError as e:
                     logger.debug('Thumbnail not found.'.format(
                         thumb=thumbgen_filename))
+            if worker.queue_enabled():
+                models.enqueue_tag_job(model.checksum, session=session)
             session.commit()
 
     @expose('/new/', methods=('GET', 'POST'))
@@ -0,0 +1,115 @@
+"""Background processing of the queued tag estimation jobs.
+
+Uploads only add a :class:`i2v.models.TagJob`; ``i2v worker`` processes
+claim pending jobs in batches, run them through the network together and
+store the estimations. Several workers can run at the same time.
+"""
+from datetime import datetime
+import os
+import socket
+import time
+
+import structlog
+
+from . import metrics, models
+
+
+logger = structlog.getLogger(__name__)
+
+
+def queue_enabled():
+    """Return whether the server leaves tagging to the job queue."""
+    return os.getenv('ILLUSTRATION2VEC_TAG_QUEUE', '').lower() in ('1', 'true', 'yes')
+
+
+def prediction_tags(prediction, mode, **kwargs):
+    """Return the tags of ``prediction`` for an estimation ``mode``.
+
+    Keyword arguments are passed to the method of the mode.
+    """
+    if mode == models.MODE_PLAUSIBLE_TAG:
+        return prediction.plausible_tags(**kwargs)
+    elif mode == models.MODE_TOP_TAG:
+        return prediction.top_tags(**kwargs)
+    elif mode == models.MODE_ALL_TAG:
+        return prediction.all_tags(**kwargs)
+    raise ValueError('unknown mode: {}'.format(mode))
+
+
+def _prepare(illust2vec, checksum):
+    """Return the input of ``checksum``, or None if its prediction is cached."""
+    cache = illust2vec.prediction_cache
+    if cache is not None and checksum.value in cache:
+        return None
+    if not checksum.images:
+        raise ValueError('checksum {} does not have an image'.format(checksum.id))
+    return illust2vec._prepare_image(checksum.images[0].full_path)
+
+
+def _finish(job, status, error=None):
+    job.status = status
+    job.error = error
+    job.finished_at = datetime.now()
+
+
+def process_tag_jobs(illust2vec, jobs, session=None):
+    """Estimate and store the tags of claimed ``jobs`` with one forward pass."""
+    session = models.db.session if session is None else session
+    inputs = {}
+    for job in jobs:
+        if job.checksum_id in inputs:
+            continue
+        try:
+            inputs[job.checksum_id] = _prepare(illust2vec, job.checksum)
+        except Exception as err:
+            logger.warning('Failed to read image.', job=job.id, error=str(err))
+            inputs[job.checksum_id] = err
+    ready = [job for job in jobs if not isinstance(inputs[job.checksum_id], Exception)]
+    for job in jobs:
+        if job not in ready:
+            _finish(job, models.JOB_FAILED, str(inputs[job.checksum_id]))
+    checksums = {job.checksum_id: job.checksum for job in ready}
+    rows = {}
+    if checksums:
+        prediction = illust2vec.predict(
+            [inputs[c_id] for c_id in checksums],
+            keys=[checksum.value for checksum in checksums.values()],
+            batch_size=len(checksums))
+        rows = dict(zip(checksums, prediction))
+    with metrics.timed('db_write', len(jobs)):
+        for job in ready:
+            tags = prediction_tags(rows[job.checksum_id], job.mode.code)[0]
+            job.checksum.bulk_update_tag_estimation(
+                tags, mode=job.mode.code, session=session)
+            _finish(job, models.JOB_DONE)
+        session.commit()
+    logger.debug('Jobs processed.', size=len(jobs), failed=len(jobs) - len(ready))
+    return len(ready)
+
+
+def run_worker(illust2vec, batch_size=16, poll_interval=1.0, stale_after=600,
+               once=False, name=None):
+    """Claim and process tag jobs until interrupted.
+
+    With ``once``, return when no pending job is left. Returns the number of
+    jobs processed successfully.
+    """
+    name = name or '{}:{}'.format(socket.gethostname(), os.getpid())
+    session = models.db.session
+    processed = 0
+    while True:
+        jobs = models.claim_tag_jobs(
+            name, limit=batch_size, stale_after=stale_after, session=session)
+        if not jobs:
+            if once:
+                return processed
+            time.sleep(poll_interval)
+            continue
+        try:
+            processed += process_tag_jobs(illust2vec, jobs, session=session)
+        except Exception as err:
+            logger.exception('Batch failed.', size=len(jobs))
+            session.rollback()
+            for job in jobs:
+                _finish(job, models.JOB_FAILED, str(err))
+            session.commit()
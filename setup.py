@@ -9,6 +9,14 @@ setup(
     name="illustration2vec",
     version="2.0.1",
     packages=find_packages(),
+    include_package_data=True,
+    # the migrations directory is not a package, so list its files here too
+    package_data={
+        'i2v': [
+            'migrations/*.ini', 'migrations/*.mako', 'migrations/*.py',
+            'migrations/README', 'migrations/versions/*.py',
+        ],
+    },
     install_requires=[
         'appdirs==1.4.3',
         'arrow>=0.12.1',
@@ -19,7 +27,7 @@ setup(
         'flask-restful-swagger>=0.20.1',
         'Flask-RESTful>=0.3.6',
         'flask-shell-ipython==0.3.0',
-        'Flask-SQLAlchemy==2.3.2',
+        'Flask-SQLAlchemy>=2.4.0',
         'Flask-WTF==0.14.2',
         'Flask==1.0.2',
         'numpy>=1.14.3',
@@ -42,12 +50,14 @@ setup(
     },
     long_description=long_description,
     long_description_content_type='text/markdown',
-    zip_safe=True,
     entry_points={'console_scripts': ['i2v = i2v.__main__:cli', ],},
     extras_require={
         'dev':  [
             'pdbpp>=0.9.2',
             'ipython>=6.4.0',
         ],
+        'postgresql': [
+            'psycopg2-binary>=2.7',
+        ],
     },
 )
@@ -0,0 +1,112 @@
+"""Compare the PIL preprocessing of ChainerI2V with the original one.
+
+The original pipeline resized a float copy of every image with
+``resize_image`` (skimage, bilinear) and built the network input by
+flipping the channels, subtracting the mean and transposing the whole
+batch. ``_prepare_image`` now resizes 8-bit images with PIL's bilinear
+filter and ``_forward_many`` fuses the other steps into one pass per image.
+
+The fused steps must reproduce the original input exactly. The two
+bilinear filters differ slightly, mostly along edges, so the resized
+inputs are only required to agree within ``MEAN_TOLERANCE`` (mean absolute
+difference on the 0-255 scale of the pixels).
+"""
+import os.path as op
+
+import numpy as np
+from PIL import Image
+import pytest
+
+from i2v.base import open_image
+from i2v.chainer_i2v import ChainerI2V
+from i2v.preprocess import PreprocessPool
+from i2v.store import PredictionCache
+
+
+MEAN_TOLERANCE = 1.5
+IMAGE_PATH = op.join(op.dirname(op.dirname(op.abspath(__file__))), 'images', 'miku.jpg')
+
+
+class RecordingNet(object):
+    """Stand-in for a CaffeFunction returning its input blob."""
+
+    layers = []
+    forwards = {}
+
+    def __call__(self, inputs, outputs, disable=()):
+        return [inputs['data'].array]
+
+
+@pytest.fixture
+def illust2vec():
+    return ChainerI2V(RecordingNet())
+
+
+@pytest.fixture(scope='module')
+def image():
+    with Image.open(IMAGE_PATH) as image:
+        image.load()
+        return image
+
+
+def baseline_input(illust2vec, image):
+    """Return the network input of ``image`` built as before the PIL path."""
+    arr = illust2vec.resize_image(illust2vec._convert_image(image), illust2vec.input_size)
+    input_ = arr[np.newaxis, :, :, ::-1] - illust2vec.mean
+    return input_.transpose((0, 3, 1, 2))[0]
+
+
+def fused_input(illust2vec, image):
+    return illust2vec._forward([illust2vec._prepare_image(image)], 'data')[0]
+
+
+def test_fused_input_matches_baseline(illust2vec, image):
+    arr = illust2vec.resize_image(illust2vec._convert_image(image), illust2vec.input_size)
+    fused = illust2vec._forward([arr], 'data')[0]
+    expected = (arr[:, :, ::-1] - illust2vec.mean).transpose((2, 0, 1))
+    assert fused.dtype == np.float32
+    np.testing.assert_allclose(fused, expected, atol=1e-4)
+
+
+@pytest.mark.parametrize('convert', [
+    lambda image: image,
+    lambda image: image.convert('L'),
+    lambda image: image.convert('RGBA'),
+    lambda image: image.resize((1200, 900), Image.LANCZOS),
+    lambda image: image.resize((160, 120), Image.LANCZOS),
+], ids=['rgb', 'grayscale', 'rgba', 'downscale', 'upscale'])
+def test_pil_resize_within_tolerance(illust2vec, image, convert):
+    image = convert(image)
+    fused = fused_input(illust2vec, image)
+    expected = baseline_input(illust2vec, image)
+    assert fused.shape == expected.shape == (3, 224, 224)
+    assert np.abs(fused - expected).mean() < MEAN_TOLERANCE
+
+
+def test_prepared_array_is_not_resized_again(illust2vec, image):
+    prepared = illust2vec._prepare_image(image)
+    np.testing.assert_array_equal(illust2vec._prepare_image(prepared), prepared)
+
+
+def test_preprocess_pool_with_spawned_workers(illust2vec, image, tmp_path):
+    # the cache holds locks, which must not be sent to the workers
+    illust2vec.prediction_cache = PredictionCache(str(tmp_path / 'cache'))
+    images = [image, image.convert('L')]
+    with PreprocessPool(illust2vec, processes=1, chunk_size=1, context='spawn') as pool:
+        prepared = pool.map(images)
+    expected = np.stack([illust2vec._prepare_image(img) for img in images])
+    np.testing.assert_array_equal(prepared, expected)
+
+
+def test_jpeg_path_decoded_at_reduced_scale(illust2vec, image, tmp_path):
+    path = str(tmp_path / 'large.jpg')
+    image.resize((1800, 1350), Image.LANCZOS).save(path, quality=95)
+    height, width = illust2vec.input_size
+    # the JPEG is decoded at half scale, the smallest one at least 448x448
+    assert open_image(path, draft_size=(2 * width, 2 * height)).size == (900, 675)
+    prepared = illust2vec._prepare_image(path)
+    with Image.open(path) as full:
+        full.load()
+        expected = illust2vec._prepare_image(full)
+    assert prepared.shape == expected.shape == (224, 224, 3)
+    assert np.abs(prepared - expected).mean() < MEAN_TOLERANCE